@@ -1,5 +1,6 @@
 import investor_simulator as invsim
 import os
+import random
 import pandas as pd
 import seaborn as sns
 import numpy as np
@@ -14,22 +15,35 @@ register_matplotlib_converters()
 # set dates and budget
 start_date = datetime(2016, 9, 1)
 end_date = datetime(2021, 1, 1)
+budget = 'max(N(20000, 5000), 0)'  # drawn for each portfolio, stored with the simulations
+n = 500
 
 
-# Call Portfolios
-defensive_group = [invsim.Portfolio(invsim.Investor(invsim.defensive, max(random.gauss(20000, 5000), 0)),
-                                    start_date=start_date, end_date=end_date) for _ in range(500)]
+# Call Portfolios. Their values are stored in Results/simulations, later runs read them back as long
+# as they were simulated with the same parameters. Delete the directory to simulate again.
+def build_groups():
+    defensive_group = [invsim.Portfolio(invsim.Investor(invsim.defensive, max(random.gauss(20000, 5000), 0)),
+                                        start_date=start_date, end_date=end_date) for _ in range(n)]
 
-aggressive_group = [invsim.Portfolio(invsim.Investor(invsim.aggressive, max(random.gauss(20000, 5000), 0)),
-                                     start_date=start_date, end_date=end_date) for _ in range(500)]
+    aggressive_group = [invsim.Portfolio(invsim.Investor(invsim.aggressive, max(random.gauss(20000, 5000), 0)),
+                                         start_date=start_date, end_date=end_date) for _ in range(n)]
+
+    mixed_group = [invsim.Portfolio(invsim.Investor(invsim.mixed, max(random.gauss(20000, 5000), 0)),
+                                    start_date=start_date, end_date=end_date) for _ in range(n)]
+    return [defensive_group, aggressive_group, mixed_group]
 
-mixed_group = [invsim.Portfolio(invsim.Investor(invsim.mixed, max(random.gauss(20000, 5000), 0)),
-                                start_date=start_date, end_date=end_date) for _ in range(500)]
 
-groups = [defensive_group, aggressive_group, mixed_group]
 names = ['defensive', 'aggressive', 'mixed']
+store = [os.path.abspath(f'../Results/simulations/pb_{name}') for name in names]
+params = [dict(mode=name, budget=budget, n_paths=n, start_date=start_date, end_date=end_date,
+               investment_weights=weights) for name, weights in zip(names, [(75, 25)] * 3)]
+groups = [invsim.load_matching_simulation(path, **group_params) for path, group_params in zip(store, params)]
+if any(group is None for group in groups):
+    groups = [invsim.portfolios_simulation(group, budget=budget) for group in build_groups()]
+    for group, path in zip(groups, store):
+        invsim.save_simulation(group, path)
 
-results = invsim.return_and_vol_on_portfolios(groups, names)
+results = invsim.return_and_vol_on_simulations(groups, names)
 
 fig, ax = plt.subplots(figsize=(8, 2))
 ax.xaxis.set_visible(False)
@@ -42,7 +56,7 @@ tabla.scale(1.2, 1.5)
 plt.savefig('../Results/pb_portfolios_returns_and_vol.png', transparent=True)
 
 
-means = invsim.mean_monthly_value_on_portfolios(groups, names)
+means = invsim.mean_monthly_value_on_simulations(groups, names)
 
 sns.set_theme()
 sns.set_context("paper", font_scale=1.5)
@@ -55,7 +69,7 @@ ax.xaxis.set_major_formatter(date_form)
 plt.savefig(os.path.abspath('../Results/pb_portfolios_monthly_price_plot.png'), dpi=800)
 
 
-results = invsim.mean_yearly_return_on_portfolios(groups, names)
+results = invsim.mean_yearly_return_on_simulations(groups, names)
 
 
 sns.set_theme()
@@ -72,10 +86,8 @@ plt.savefig(os.path.abspath('../Results/pb_portfolios_annual_return_plot.png'),
 
 # What is the best stock.
 
-return_on_stocks = pd.DataFrame([invsim.Stocks(x, start_date=datetime(2016, 12, 31),
-                                end_date=datetime(2017, 12, 31)).return_on_stock(datetime(2017, 12, 31))
-                                for x in invsim.tickers], index=invsim.tickers,
-                                columns=['Return']).sort_values('Return', ascending=False)
+return_on_stocks = (invsim.get_price_index().returns(datetime(2016, 12, 31), datetime(2017, 12, 31))
+                    .loc[invsim.tickers].to_frame().sort_values('Return', ascending=False))
 
 
 sns.set_theme()
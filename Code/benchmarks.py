@@ -0,0 +1,141 @@
+import investor_simulator as invsim
+import argparse
+import json
+import platform
+import random
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+# Benchmarks of the simulation hot paths on a synthetic, offline price panel.
+# Usage: python benchmarks.py [--quick] [--output results.json] [--compare previous.json] [--cases name ...]
+
+start_date = datetime(2016, 9, 1)
+end_date = datetime(2021, 1, 1)
+tickers = ['FDX', 'GOOGL', 'XOM', 'KO', 'NOK', 'MS', 'IBM']
+
+
+def synthetic_prices(seed=0):
+    """Geometric random walk on business days for the default tickers"""
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(datetime(2009, 12, 1), datetime(2021, 6, 30), name='Date')
+    first_prices = np.array([100, 600, 80, 40, 5, 30, 150])
+    steps = rng.normal(0.0003, 0.015, size=(len(dates), len(tickers)))
+    return pd.DataFrame(first_prices * np.exp(np.cumsum(steps, axis=0)), index=dates, columns=tickers)
+
+
+def group(mode, budget, n, investment_weights=(75, 25)):
+    return [invsim.Portfolio(invsim.Investor(mode, budget() if callable(budget) else budget),
+                             start_date=start_date, end_date=end_date, investment_weights=investment_weights)
+            for _ in range(n)]
+
+
+def simulations(n):
+    """Simulations.py: 3 groups of n portfolios, budget 50000, mixed weighted (25, 75)"""
+    groups = [group(invsim.defensive, 50000, n), group(invsim.aggressive, 50000, n),
+              group(invsim.mixed, 50000, n, (25, 75))]
+    aggregate(groups)
+
+
+def simulation_bonus(n):
+    """Simulation_bonus.py: 3 groups of n portfolios with budgets drawn from N(20000, 5000)"""
+    def budget():
+        return max(random.gauss(20000, 5000), 0)
+    groups = [group(mode, budget, n) for mode in (invsim.defensive, invsim.aggressive, invsim.mixed)]
+    aggregate(groups)
+
+
+def aggregate(groups):
+    names = ['defensive', 'aggressive', 'mixed']
+    invsim.return_and_vol_on_portfolios(groups, names)
+    invsim.mean_monthly_value_on_portfolios(groups, names)
+    invsim.mean_yearly_return_on_portfolios(groups, names)
+
+
+def cases(scale):
+    """Returns {name: (kind, calls, setup, function)}. setup() builds the argument passed to function"""
+    n_micro, n_group, n_macro = 200 * scale, 20 * scale, 50 * scale
+    return {
+        'stocks_init': ('micro', n_micro, lambda: None,
+                        lambda _: invsim.Stocks('KO', start_date, end_date, num_stocks=10)),
+        'bonds_init': ('micro', n_micro, lambda: None,
+                       lambda _: invsim.Bonds.long(start_date, pv=2000)),
+        'accounting_investment': ('micro', n_group, lambda: group(invsim.aggressive, 0, 1)[0],
+                                  lambda p: invsim.accounting_investment(invsim._Tranche(p, 5000, start_date))),
+        'mixed': ('micro', n_group, lambda: None, lambda _: group(invsim.mixed, 5000, 1)),
+        'portfolio_cash_flow': ('micro', n_group, lambda: group(invsim.mixed, 5000, 1)[0],
+                                lambda p: p.portfolio_cash_flow()),
+        'return_and_vol_on_portfolios': ('micro', 1, lambda: fresh_groups(n_group),
+                                         lambda g: invsim.return_and_vol_on_portfolios(g, ['d', 'a', 'm'])),
+        'mean_monthly_value_on_portfolios': ('micro', 1, lambda: fresh_groups(n_group),
+                                             lambda g: invsim.mean_monthly_value_on_portfolios(g, ['d', 'a', 'm'])),
+        'mean_yearly_return_on_portfolios': ('micro', 1, lambda: fresh_groups(n_group),
+                                             lambda g: invsim.mean_yearly_return_on_portfolios(g, ['d', 'a', 'm'])),
+        'simulations': ('macro', 1, lambda: None, lambda _: simulations(n_macro)),
+        'simulation_bonus': ('macro', 1, lambda: None, lambda _: simulation_bonus(n_macro)),
+    }
+
+
+def fresh_groups(n):
+    return [group(mode, 5000, n) for mode in (invsim.defensive, invsim.aggressive, invsim.mixed)]
+
+
+def run_case(name, kind, calls, setup, function, memory=True):
+    """Times calls of function (setup excluded), then measures the peak memory of one call"""
+    invsim.seed(0)
+    seconds = 0
+    for _ in range(calls):
+        argument = setup()
+        start = time.perf_counter()
+        function(argument)
+        seconds += time.perf_counter() - start
+    peak_mb = None
+    if memory:
+        argument = setup()
+        tracemalloc.start()
+        function(argument)
+        peak_mb = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 3)
+        tracemalloc.stop()
+    return {'name': name, 'kind': kind, 'calls': calls, 'seconds': round(seconds, 6),
+            'per_call': round(seconds / calls, 6), 'throughput': round(calls / seconds, 3), 'peak_mb': peak_mb}
+
+
+def compare(results, previous):
+    """Prints the per call time ratio against a previous results file"""
+    before = {result['name']: result for result in previous['results']}
+    for result in results['results']:
+        if result['name'] in before:
+            ratio = result['per_call'] / before[result['name']]['per_call']
+            print(f"{result['name']:<36} {ratio:6.2f}x time")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of investor_simulator')
+    parser.add_argument('--quick', action='store_true', help='smaller groups, for a fast check')
+    parser.add_argument('--scale', type=int, default=None, help='multiplies the number of calls (default 10)')
+    parser.add_argument('--cases', nargs='*', default=None, help='names of the cases to run')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory measure')
+    parser.add_argument('--output', default=None, help='writes the results as JSON')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run')
+    args = parser.parse_args()
+
+    invsim.set_price_source(invsim.FrameSource(synthetic_prices()))
+    invsim.get_stocks_df()  # data loading is not part of any case
+    scale = args.scale or (1 if args.quick else 10)
+    results = {'timestamp': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+               'numpy': np.__version__, 'pandas': pd.__version__, 'scale': scale, 'results': []}
+    for name, case in cases(scale).items():
+        if args.cases and name not in args.cases:
+            continue
+        result = run_case(name, *case, memory=not args.no_memory)
+        results['results'].append(result)
+        print(f"{name:<36} {result['per_call']:>10.4f} s/call {result['throughput']:>10.2f} calls/s "
+              f"{result['peak_mb']} MB peak")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
@@ -1,16 +1,662 @@
 import pandas as pd
+import numpy as np
+import abc
 import itertools
-import pandas_datareader.data as web
+import json
+import os
 from pandas.tseries.offsets import BDay
-from datetime import datetime
+from datetime import datetime, timedelta
 import random
 import math
 import collections
+import concurrent.futures
+import contextlib
+import functools
+import heapq
+import shutil
+import tempfile
+import time
+import warnings
+import asyncio
+import urllib.error
+import urllib.parse
+import urllib.request
 
-# Stocks data
+# Profiling. Instrumented functions count calls and cumulative time per phase when the profiler is
+# enabled (INVSIM_PROFILE=1 or profiling()). Disabled, they only check a flag. Phases add up the self
+# time of the calls, without their instrumented callees, so their sum never exceeds the run time.
+
+
+class Profiler:
+    """Per-call counts, cumulative and self seconds of the instrumented functions"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        self.stack = []  # seconds spent in instrumented callees, one entry per running call
+
+    def enter(self):
+        self.stack.append(0.0)
+
+    def exit(self, name, phase, seconds):
+        """Records a call that took seconds, of which the callees took the top of the stack"""
+        callees = self.stack.pop() if self.stack else 0.0
+        if self.stack:
+            self.stack[-1] += seconds
+        self.record(name, phase, seconds, seconds - callees)
+
+    def record(self, name, phase, seconds, self_seconds=None):
+        counter = self.counters.setdefault(name, {'phase': phase, 'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0})
+        counter['calls'] += 1
+        counter['seconds'] += seconds
+        counter['self_seconds'] += seconds if self_seconds is None else self_seconds
+
+    def reset(self):
+        self.counters = {}
+        self.stack = []
+
+    def to_dict(self):
+        """Counters by function (seconds include the callees, self_seconds do not), plus the self seconds
+        of each phase"""
+        phases = {}
+        for counter in self.counters.values():
+            phases[counter['phase']] = phases.get(counter['phase'], 0) + counter['self_seconds']
+        return {'functions': {name: dict(counter) for name, counter in self.counters.items()}, 'phases': phases}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+profiler = Profiler(enabled=os.environ.get('INVSIM_PROFILE', '') not in {'', '0'})
+
+
+def profiled(phase):
+    """Instruments a function under a phase: data, allocation, instruments, cash flow, concatenation,
+    aggregation or simulation"""
+    def decorator(function):
+        name = function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            profiler.enter()
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.exit(name, phase, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def profiling(reset=True):
+    """Enables the profiler inside a with block and yields it"""
+    if reset:
+        profiler.reset()
+    enabled, profiler.enabled = profiler.enabled, True
+    try:
+        yield profiler
+    finally:
+        profiler.enabled = enabled
+
+
+# Stocks data. Prices come from a PriceSource and are only loaded on first use,
+# so importing the module never touches the network.
 
 tickers = ['FDX', 'GOOGL', 'XOM', 'KO', 'NOK', 'MS', 'IBM']
-stocks_df = web.DataReader(tickers, 'yahoo', start=datetime(2010, 1, 1)).High
+
+
+class Universe:
+    """Ordered tickers with an O(1) ticker -> column map and optional sampling weights.
+    Cumulative weights are computed once, so sampling never rebuilds lists"""
+
+    def __init__(self, tickers, weights=None):
+        self.tickers = list(tickers)
+        self.columns = {ticker: i for i, ticker in enumerate(self.tickers)}
+        if len(self.columns) != len(self.tickers):
+            raise ValueError('tickers must be unique')
+        self.weights = None if weights is None else [float(weight) for weight in weights]
+        self.cumulative = None if weights is None else list(itertools.accumulate(self.weights))
+        if self.weights is not None and (len(self.weights) != len(self.tickers) or min(self.weights) < 0
+                                         or self.cumulative[-1] <= 0):
+            raise ValueError('weights must be one non negative number per ticker, not all zero')
+
+    def __contains__(self, ticker):
+        return ticker in self.columns
+
+    def __iter__(self):
+        return iter(self.tickers)
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def __repr__(self):
+        return f'Universe({len(self)} tickers{", weighted" if self.weights else ""})'
+
+    def filter(self, keep):
+        """Sub universe of the tickers in keep (a collection) or for which keep(ticker) is true"""
+        if not callable(keep):
+            keep = set(keep).__contains__
+        chosen = [i for i, ticker in enumerate(self.tickers) if keep(ticker)]
+        return Universe([self.tickers[i] for i in chosen],
+                        None if self.weights is None else [self.weights[i] for i in chosen])
+
+    @classmethod
+    def from_file(cls, path):
+        """Reads one ticker per line, optionally followed by a comma and its weight. # starts a comment"""
+        rows = []
+        with open(path) as file:
+            for line in file:
+                line = line.split('#')[0].strip()
+                if line:
+                    rows.append([field.strip() for field in line.split(',')])
+        if any(len(row) > 1 for row in rows):
+            return cls([row[0] for row in rows], [float(row[1]) if len(row) > 1 else 1 for row in rows])
+        return cls([row[0] for row in rows])
+
+
+class PriceSource(abc.ABC):
+    """Abstract price provider. Loads a (Date x ticker) panel on first use and keeps it"""
+
+    def __init__(self, tickers=None, start=datetime(2010, 1, 1), end=None):
+        self.tickers = tickers
+        self.start = start
+        self.end = end
+        self._prices = None
+        self._universe = None
+        self._index = None
+
+    @property
+    def prices(self):
+        if self._prices is None:
+            self._prices = _load_prices(self)
+            self._universe = Universe(self._prices.columns)
+        return self._prices
+
+    @property
+    def universe(self):
+        """Tickers available on the panel, with their column numbers"""
+        if self._universe is None:
+            self.prices
+        return self._universe
+
+    @property
+    def index(self):
+        """As-of price lookup built once from the panel"""
+        if self._index is None:
+            self._index = PriceIndex(self.prices)
+        return self._index
+
+    @abc.abstractmethod
+    def fetch(self, tickers, start, end):
+        """Returns prices of tickers (all if None) between start and end (open if None)"""
+
+
+class YahooSource(PriceSource):
+    """Daily prices from Yahoo through pandas_datareader"""
+
+    def __init__(self, tickers=tickers, start=datetime(2010, 1, 1), end=None, field='High'):
+        super(YahooSource, self).__init__(tickers, start, end)
+        self.field = field
+
+    def fetch(self, tickers, start, end):
+        import pandas_datareader.data as web
+        return web.DataReader(tickers, 'yahoo', start=start, end=end)[self.field]
+
+
+class AsyncYahooSource(PriceSource):
+    """Daily prices from the Yahoo chart API, one request per ticker.
+
+    Tickers are fetched concurrently (at most `concurrency` requests at once) with asyncio over
+    urllib, each one retried `retries` times with a growing delay. Tickers that still fail are left
+    out of the panel and kept in `errors` (ticker -> exception), so a CachedSource fetches them again
+    on its next refresh. `url` is a template with {ticker}, {period1} and {period2} (Unix seconds),
+    e.g. a local server in tests.
+    """
+
+    url = 'https://query1.finance.yahoo.com/v8/finance/chart/{ticker}?period1={period1}&period2={period2}&interval=1d'
+
+    def __init__(self, tickers=tickers, start=datetime(2010, 1, 1), end=None, field='High', url=None,
+                 concurrency=16, retries=3, retry_delay=0.5, timeout=30):
+        super(AsyncYahooSource, self).__init__(tickers, start, end)
+        self.field = field
+        self.url = url or AsyncYahooSource.url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.errors = {}
+
+    def fetch(self, tickers, start, end):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.fetch_async(tickers, start, end))
+        # An event loop already runs on this thread (e.g. Jupyter), the fetch gets its own on another one
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.fetch_async(tickers, start, end)).result()
+
+    async def fetch_async(self, tickers, start, end):
+        """Same as fetch, from a running event loop"""
+        start = pd.Timestamp(start if start is not None else self.start)
+        end = pd.Timestamp(end) if end is not None else pd.Timestamp.today().normalize()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = await asyncio.gather(*[self._fetch_ticker(ticker, start, end, semaphore, executor)
+                                             for ticker in tickers])
+        self.errors = {ticker: result for ticker, result in zip(tickers, results) if isinstance(result, Exception)}
+        series = {ticker: result for ticker, result in zip(tickers, results) if not isinstance(result, Exception)}
+        frame = pd.DataFrame(series, index=None if series else pd.DatetimeIndex([]), columns=list(series),
+                             dtype=float).rename_axis('Date')
+        return frame.loc[start:end]
+
+    async def _fetch_ticker(self, ticker, start, end, semaphore, executor):
+        """Prices of a ticker as a Series, or the last exception once the retries are spent"""
+        url = self.url.format(ticker=urllib.parse.quote(ticker), period1=int(start.timestamp()),
+                              period2=int((end + pd.Timedelta(days=1)).timestamp()))
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            try:
+                async with semaphore:
+                    body = await loop.run_in_executor(executor, self._download, url)
+                return self._parse(body)
+            except urllib.error.HTTPError as error:
+                if error.code not in {408, 429} and error.code < 500:  # unknown ticker, no point in retrying
+                    return error
+                last = error
+            except (urllib.error.URLError, OSError, ValueError, KeyError, TypeError) as error:
+                last = error
+            if attempt < self.retries:
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        return last
+
+    def _download(self, url):
+        request = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read()
+
+    def _parse(self, body):
+        """Series of the field by Date from a chart API response"""
+        result = json.loads(body)['chart']['result'][0]
+        dates = pd.to_datetime(np.array(result['timestamp']) + result['meta'].get('gmtoffset', 0), unit='s')
+        values = np.array(result['indicators']['quote'][0][self.field.lower()], dtype=float)
+        series = pd.Series(values, index=dates.normalize().rename('Date'))
+        return series[~series.index.duplicated(keep='last')]
+
+
+class FrameSource(PriceSource):
+    """Prices from an in-memory DataFrame indexed by date with one column per ticker"""
+
+    def __init__(self, frame, tickers=None, start=None, end=None):
+        super(FrameSource, self).__init__(tickers, start, end)
+        self.frame = frame
+
+    def fetch(self, tickers, start, end):
+        frame = _normalize_prices(self.frame)
+        if tickers is not None:
+            frame = frame.loc[:, list(tickers)]
+        return frame.loc[start:end]
+
+
+class FileSource(FrameSource):
+    """Prices from a local Parquet or CSV file with the same layout as FrameSource"""
+
+    def __init__(self, path, tickers=None, start=None, end=None):
+        super(FileSource, self).__init__(None, tickers, start, end)
+        self.path = path
+
+    def fetch(self, tickers, start, end):
+        if self.frame is None:
+            # Only the columns of the requested tickers are read
+            columns = None if tickers is None else list(tickers)
+            if str(self.path).endswith('.parquet'):
+                self.frame = pd.read_parquet(self.path, columns=columns)
+            else:
+                if columns is not None:
+                    columns = [pd.read_csv(self.path, nrows=0).columns[0]] + columns
+                self.frame = pd.read_csv(self.path, index_col=0, parse_dates=True, usecols=columns)
+        return super(FileSource, self).fetch(tickers, start, end)
+
+
+class CachedSource(PriceSource):
+    """Prices kept on a local memory-mapped panel and completed from an upstream source.
+
+    The cache directory holds dates.npy, values.npy (column-major, one column per ticker) and
+    meta.json with the tickers and the date range already requested, in the version directory named
+    by its `current` file (see write_price_cache). Only missing tickers and the missing head/tail
+    of dates are fetched from upstream, then merged into the panel.
+    """
+
+    def __init__(self, path, upstream: PriceSource = None, tickers=None, start=None, end=None):
+        if upstream is not None:
+            tickers = upstream.tickers if tickers is None else tickers
+            start = upstream.start if start is None else start
+            end = upstream.end if end is None else end
+        super(CachedSource, self).__init__(tickers, start, end)
+        self.path = path
+        self.upstream = upstream
+
+    def fetch(self, tickers, start, end):
+        if self.upstream is None:
+            frame, meta = read_price_cache(self.path, tickers)
+        else:
+            frame, meta = self.refresh(*read_price_cache(self.path), tickers, start, end)
+            if frame is not None and tickers is not None:
+                # Tickers the upstream failed to fetch are left out, they are fetched again next time
+                cached = set(meta['tickers'])
+                frame, meta = read_price_cache(self.path, [ticker for ticker in tickers if ticker in cached])
+        if frame is None:
+            raise FileNotFoundError(f'no price cache in {self.path} and no upstream source')
+        return frame.loc[start:end]
+
+    def refresh(self, frame, meta, tickers, start, end):
+        """Fetches what the cache lacks for (tickers, start, end) and writes the merged panel"""
+        start = pd.Timestamp(start if start is not None else datetime(2010, 1, 1))
+        # Today's prices are not final: the cache is complete up to the last closed business day
+        end = pd.Timestamp(end) if end is not None else pd.Timestamp.today().normalize() - BDay(1)
+        if frame is None:
+            parts = [self.upstream.fetch(tickers, start, end)]
+        else:
+            cached_start, cached_end = pd.Timestamp(meta['start']), pd.Timestamp(meta['end'])
+            cached = set(frame.columns)
+            missing = [t for t in (tickers or []) if t not in cached]
+            known = [t for t in (tickers or frame.columns) if t in cached]
+            parts = []
+            if missing:
+                parts.append(self.upstream.fetch(missing, min(start, cached_start), max(end, cached_end)))
+            if known and start < cached_start:
+                parts.append(self.upstream.fetch(known, start, cached_start - pd.Timedelta(days=1)))
+                if getattr(self.upstream, 'errors', None):  # the head stays missing, asked again next time
+                    start = cached_start
+            if known and end > cached_end:
+                parts.append(self.upstream.fetch(known, cached_end + pd.Timedelta(days=1), end))
+                if getattr(self.upstream, 'errors', None):
+                    end = cached_end
+            start, end = min(start, cached_start), max(end, cached_end)
+        # Failed fetches (e.g. offline) give empty frames: without new prices the cache is not rewritten
+        parts = [part for part in map(_normalize_prices, parts) if not part.empty]
+        if frame is not None and not parts:
+            return frame, meta
+        merged = frame
+        for part in parts:
+            merged = part if merged is None else merged.combine_first(part)
+        if merged is None or merged.columns.empty:  # nothing fetched, an empty panel is not cached
+            raise ValueError(_no_prices_message(self.upstream))
+        write_price_cache(self.path, merged, start, end)
+        return read_price_cache(self.path)
+
+
+def write_price_cache(path, frame, start, end):
+    """Writes a price panel as memory-mappable arrays plus its metadata.
+
+    Each write goes to a new version directory, then the `current` file is switched to it at once, so
+    concurrent readers see either the old or the new panel. The previous version is kept for readers
+    still opening it, older ones are removed."""
+    os.makedirs(path, exist_ok=True)
+    frame = _normalize_prices(frame)
+    version = tempfile.mkdtemp(prefix=f'v{time.time_ns()}_', dir=path)
+    np.save(os.path.join(version, 'dates.npy'), frame.index.values.astype('datetime64[ns]'))
+    np.save(os.path.join(version, 'values.npy'), np.asfortranarray(frame.values, dtype=float))
+    meta = {'tickers': list(frame.columns), 'start': pd.Timestamp(start).isoformat(),
+            'end': pd.Timestamp(end).isoformat()}
+    with open(os.path.join(version, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+    previous = _cache_version(path)
+    with open(os.path.join(path, 'current.tmp'), 'w') as file:
+        file.write(os.path.basename(version))
+    os.replace(os.path.join(path, 'current.tmp'), os.path.join(path, 'current'))
+    for name in os.listdir(path):
+        if name in {'dates.npy', 'values.npy', 'meta.json'}:  # a cache written before versions
+            os.remove(os.path.join(path, name))
+        elif (name.startswith('v') and os.path.isdir(os.path.join(path, name))
+              and name not in {os.path.basename(version), previous}):
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def _cache_version(path):
+    """Directory name of the current version of a price cache, None if it has none"""
+    try:
+        with open(os.path.join(path, 'current')) as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def read_price_cache(path, tickers=None):
+    """Returns the cached panel (memory-mapped, no copy) and its metadata, or (None, None).
+    With tickers, only their columns are read from the map; tickers not in the cache are KeyError"""
+    for attempt in range(3):
+        version = _cache_version(path)
+        # Caches written before versions hold the files directly in path
+        directory = path if version is None else os.path.join(path, version)
+        try:
+            with open(os.path.join(directory, 'meta.json')) as file:
+                meta = json.load(file)
+            dates = np.load(os.path.join(directory, 'dates.npy'))
+            values = np.load(os.path.join(directory, 'values.npy'), mmap_mode='r')
+            break
+        except FileNotFoundError:
+            if version is None or _cache_version(path) == version:
+                return None, None
+            # Replaced and removed by two writes while being opened, the current one is read instead
+    else:
+        return None, None
+    columns = meta['tickers']
+    if tickers is not None and list(tickers) != columns:
+        # Columns are contiguous in the file, each selected one is a single read
+        universe = Universe(columns)
+        columns = list(tickers)
+        missing = [ticker for ticker in columns if ticker not in universe]
+        if missing:
+            raise KeyError(f'tickers not in the price cache: {missing}')
+        values = np.asfortranarray(values[:, [universe.columns[ticker] for ticker in columns]])
+    frame = pd.DataFrame(values, index=pd.DatetimeIndex(dates, name='Date'), columns=columns, copy=False)
+    return frame, meta
+
+
+class PriceIndex:
+    """Price lookup without pandas. Dates are offsets on the shared calendar: one sorted array of dates
+    and prices per ticker, the trading days of the panel and a daily as-of price matrix"""
+
+    def __init__(self, prices):
+        self.dates = {}
+        self.values = {}
+        for ticker in prices.columns:
+            column = prices[ticker].dropna()
+            self.dates[ticker] = calendar.offsets(column.index)
+            self.values[ticker] = column.values
+        self.columns = {ticker: i for i, ticker in enumerate(prices.columns)}
+        self.trading = calendar.offsets(prices.index)
+        # Daily as-of prices (column major) from the first to the last trading day, rows are offsets
+        self.first_offset = self.trading[0] if len(prices) else 0
+        rows = self.trading - self.first_offset
+        self.daily = np.full((rows[-1] + 1 if len(prices) else 0, len(self.columns)), np.nan, order='F')
+        self.daily[rows] = prices.values
+        self.daily = np.asfortranarray(pd.DataFrame(self.daily).fillna(method='pad').values)
+        self._log_daily = None
+
+    @property
+    def log_daily(self):
+        """Cumulative log return of every ticker on the daily rows (the log of the as-of price, built on
+        first use). The return between two days is exp of a subtraction"""
+        if self._log_daily is None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self._log_daily = np.log(self.daily)
+        return self._log_daily
+
+    def _gather(self, matrix, offsets, columns=None):
+        """Rows of a daily matrix for calendar offsets, as-of after the last day and NaN before the first"""
+        rows = np.asarray(offsets) - self.first_offset
+        gathered = matrix[np.clip(rows, 0, len(matrix) - 1)]
+        if columns is not None:
+            gathered = gathered[..., columns]
+        return np.where((rows < 0)[..., None] if gathered.ndim > rows.ndim else rows < 0, np.nan, gathered)
+
+    def log_returns(self, starts, ends, columns=None):
+        """Log returns between the as-of prices of calendar offsets starts and ends (arrays of the same
+        shape), one row per pair and one column per ticker"""
+        return self._gather(self.log_daily, ends, columns) - self._gather(self.log_daily, starts, columns)
+
+    def returns(self, start_date, end_date):
+        """Return of every ticker between the as-of prices of two dates, as a Series"""
+        log_returns = self.log_returns(calendar.offset(start_date), calendar.offset(end_date))
+        return pd.Series(np.expm1(log_returns), index=list(self.columns), name='Return')
+
+    def period_returns(self, dates):
+        """Return of every ticker between consecutive dates (e.g. year ends), one row per period
+        labelled by its last date. Same as pct_change on the as-of prices of the dates"""
+        offsets = calendar.offsets(pd.DatetimeIndex(dates))
+        log_returns = self.log_returns(offsets[:-1], offsets[1:])
+        return pd.DataFrame(np.expm1(log_returns), index=pd.DatetimeIndex(dates[1:], name='Date'),
+                            columns=list(self.columns))
+
+    def daily_matrix(self, start, stop, columns=None):
+        """As-of prices for the calendar offsets [start, stop) and the given column numbers (all if None).
+        The last price is carried forward, days before the first one are NaN"""
+        first, last = start - self.first_offset, stop - self.first_offset
+        if 0 <= first and last <= len(self.daily):
+            return self.daily[first:last] if columns is None else self.daily[first:last, columns]
+        daily = self.daily if columns is None else self.daily[:, columns]
+        rows = np.arange(first, last)
+        prices = daily[np.clip(rows, 0, len(daily) - 1)]
+        prices[rows < 0] = np.nan
+        return prices
+
+    def daily_prices(self, ticker, start, stop):
+        """As-of prices of a ticker for the calendar offsets [start, stop)"""
+        column = self.columns[ticker]
+        if self.first_offset <= start and stop - self.first_offset <= len(self.daily):
+            return self.daily[start - self.first_offset:stop - self.first_offset, column]
+        return self.daily_matrix(start, stop, [column])[:, 0]
+
+    def _cell(self, ticker, date):
+        """(row, column) of the as-of price of ticker on date in the daily matrices"""
+        row, column = min(calendar.offset(date) - self.first_offset, len(self.daily) - 1), self.columns[ticker]
+        if row < 0 or np.isnan(self.daily[row, column]):
+            raise KeyError(f'no {ticker} price on or before {date}')
+        return row, column
+
+    def as_of(self, ticker, date):
+        """Last price on or before date"""
+        return self.daily[self._cell(ticker, date)]
+
+    def log_as_of(self, ticker, date):
+        """Log of the last price on or before date"""
+        return self.log_daily[self._cell(ticker, date)]
+
+    def first(self, ticker, start, end):
+        """First price between start and end, as the first row of the panel sliced on [start, end]"""
+        dates = self.dates[ticker]
+        i = dates.searchsorted(calendar.offset(start))
+        if i == len(dates) or dates[i] > calendar.offset(end):
+            raise KeyError(f'no {ticker} price between {start} and {end}')
+        return self.values[ticker][i]
+
+
+def _previous_business_day(date):
+    """Same as date - BDay(1), without the pandas offset machinery"""
+    return date - timedelta(days={0: 3, 6: 2}.get(date.weekday(), 1))
+
+
+@profiled('data')
+def _load_prices(source):
+    prices = _normalize_prices(source.fetch(source.tickers, source.start, source.end))
+    if prices.columns.empty:
+        raise ValueError(_no_prices_message(source))
+    return prices
+
+
+def _no_prices_message(source):
+    """Error message of a source that returned no ticker, with the first errors it kept if any"""
+    errors = getattr(source, 'errors', None) or {}
+    message = f'no prices loaded from {type(source).__name__}'
+    if errors:
+        message += ': ' + '; '.join(f'{ticker}: {error}' for ticker, error in list(errors.items())[:3])
+    return message
+
+
+def _normalize_prices(frame):
+    """Sorted DatetimeIndex named 'Date' (Stocks merges on it), float columns"""
+    if (isinstance(frame.index, pd.DatetimeIndex) and frame.index.name == 'Date'
+            and frame.index.is_monotonic_increasing and all(isinstance(c, str) for c in frame.columns)
+            and all(dtype == float for dtype in frame.dtypes)):
+        return frame
+    frame = frame.copy()
+    frame.index = pd.DatetimeIndex(frame.index, name='Date')
+    frame.columns = [str(column) for column in frame.columns]
+    return frame.sort_index().astype(float)
+
+
+# The configured source. INVSIM_PRICES points to a local file for offline runs, otherwise Yahoo
+# prices are cached under INVSIM_CACHE (~/.cache/investor_simulator by default).
+_price_source = None
+
+
+def set_price_source(source: PriceSource):
+    """Configures where Stocks, the allocation samplers and OneOfStock read prices from"""
+    global _price_source
+    _price_source = source
+    # Caches keyed by the source would keep the panels of the previous ones alive
+    _stock_prices.cache_clear()
+    _shared_price_matrix.cache_clear()
+
+
+def get_price_source():
+    """Returns the configured source, creating the default one if needed"""
+    if _price_source is None:
+        path = os.environ.get('INVSIM_PRICES')
+        if path:
+            set_price_source(FileSource(path))
+        else:
+            cache = os.environ.get('INVSIM_CACHE', os.path.join('~', '.cache', 'investor_simulator'))
+            set_price_source(CachedSource(os.path.expanduser(cache), upstream=AsyncYahooSource()))
+    return _price_source
+
+
+def get_stocks_df():
+    """Returns the price panel, loading it on first use"""
+    return get_price_source().prices
+
+
+def get_price_index():
+    """Returns the as-of price lookup of the configured source"""
+    return get_price_source().index
+
+
+# The universe portfolios and simulate draw stocks from. None samples uniformly every ticker of the source.
+_universe = None
+
+
+def set_universe(universe):
+    """Restricts or weights the stocks drawn, e.g. set_universe(Universe.from_file('universe.txt')).
+    A list of tickers is a uniform universe, None resets to every ticker of the source"""
+    global _universe
+    universe = universe if universe is None or isinstance(universe, Universe) else Universe(universe)
+    if universe is not None:
+        unknown = [ticker for ticker in universe if ticker not in get_price_source().universe]
+        if unknown:
+            raise ValueError('tickers not on the price source: ' + ', '.join(f"'{ticker}'" for ticker in unknown))
+    _universe = universe
+
+
+def get_universe():
+    """Returns the universe stocks are drawn from"""
+    return get_price_source().universe if _universe is None else _universe
+
+
+def load_universe(path):
+    """Draws stocks from the tickers of a file (see Universe.from_file) and returns the universe"""
+    set_universe(Universe.from_file(path))
+    return _universe
+
+
+def __getattr__(name):
+    # Keeps `investor_simulator.stocks_df` working without loading prices at import time
+    if name == 'stocks_df':
+        return get_stocks_df()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # Descriptors guarantee the type and behavior of variables
@@ -36,10 +682,13 @@ class OneOfStock:
         self.storage_name = storage_name
 
     def __set__(self, instance, value):
-        if value in set(tickers):
+        universe = get_price_source().universe
+        if value in universe:
             instance.__dict__[self.storage_name] = value
+        elif len(universe) > 10:
+            raise ValueError(f"'{value}' is not one of the {len(universe)} tickers of the price source")
         else:
-            raise ValueError("value must be on of 'FDX', 'GOOGL', 'XOM', 'KO', 'NOK', 'MS', 'IBM'")
+            raise ValueError('value must be one of ' + ', '.join(f"'{symbol}'" for symbol in universe))
 
 
 class OneOfMode:
@@ -91,64 +740,233 @@ class Investment:
         return round(self.cash_flow.pct_change().std(), 4)
 
 
+# Bond curves only depend on rate and term, every bond with the same ones shares them.
+
+
+@functools.lru_cache(maxsize=None)
+def _bond_curve(rate, days):
+    """Daily value of 1 invested in a bond for a term of days. Shared and read only"""
+    curve = (1 + rate) ** (np.arange(days) / 365)
+    curve.flags.writeable = False
+    return curve
+
+
+@functools.lru_cache(maxsize=256)  # bonds of rolled over portfolios each have their own dates
+def _daily_dates(start_date, end_date):
+    """Daily dates on [start_date, end_date)"""
+    dates = pd.date_range(start_date, end_date, freq='D', name='Date')
+    return dates[dates < end_date]
+
+
+# Month and year ends of a date range, with their rows in the daily values of that range. Monthly values
+# and yearly returns of any number of paths are a gather on these rows, as resample(...).asfreq() gives.
+Periods = collections.namedtuple('Periods', ['month_ends', 'month_rows', 'year_ends', 'year_rows'])
+
+
+@functools.lru_cache(maxsize=64)
+def period_boundaries(start_date, end_date):
+    """Periods of the daily dates on [start_date, end_date). Rows are -1 where a period end falls after
+    the last date; year rows then take the previous year end, as pct_change pads"""
+    dates = _daily_dates(start_date, end_date)
+    if not len(dates):
+        empty = np.empty(0, dtype=int)
+        return Periods(pd.DatetimeIndex([], name='Date'), empty, pd.DatetimeIndex([], name='Date'), empty)
+    month_ends = pd.date_range(dates[0], dates[-1] + pd.offsets.MonthEnd(0), freq='M', name='Date')
+    year_ends = pd.date_range(dates[0], dates[-1] + pd.offsets.YearEnd(0), freq='Y', name='Date')
+    month_rows, year_rows = (np.where(ends <= dates[-1], (ends - dates[0]).days, -1)
+                             for ends in (month_ends, year_ends))
+    for rows in (month_rows, year_rows):
+        rows.flags.writeable = False
+    year_rows = np.maximum.accumulate(year_rows)
+    year_rows.flags.writeable = False
+    return Periods(month_ends, month_rows, year_ends, year_rows)
+
+
+def gather_periods(values, rows):
+    """Values (one path or a paths x days matrix) on the rows of period_boundaries, NaN where -1"""
+    gathered = np.asarray(values[..., np.maximum(rows, 0)], dtype=float)
+    gathered[..., rows < 0] = np.nan
+    return gathered
+
+
+def _period_returns(prices):
+    """Returns between consecutive period values, NaN for the first period (as pct_change)"""
+    returns = np.full(np.shape(prices), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns[..., 1:] = prices[..., 1:] / prices[..., :-1] - 1
+    return returns
+
+
+class Calendar:
+    """Daily calendar shared by every instrument and portfolio. Dates are int offsets from the origin"""
+
+    def __init__(self, origin=datetime(1970, 1, 1)):
+        self.origin = origin
+
+    def offset(self, date):
+        return (date - self.origin).days
+
+    def offsets(self, dates):
+        """Offsets of a DatetimeIndex, as an int array"""
+        return (dates.values.astype('datetime64[D]') - np.datetime64(self.origin, 'D')).astype(np.int64)
+
+    def dates(self, start, stop):
+        """Dates of the offsets [start, stop)"""
+        return _daily_dates(self.origin + timedelta(days=start), self.origin + timedelta(days=stop))
+
+
+calendar = Calendar()
+
+
+class Position:
+    """Compact holding: a ticker (stocks) or a rate (bonds), a quantity (shares or pv) and the calendar
+    offsets [start, end) it is held on. Values are computed on demand from shared prices and curves"""
+    __slots__ = ('instrument', 'quantity', 'start', 'end')
+
+    def __init__(self, instrument, quantity, start: int, end: int):
+        self.instrument = instrument
+        self.quantity = quantity
+        self.start = start
+        self.end = end
+
+    def values(self, start: int = None, stop: int = None):
+        """Daily values on the calendar offsets [start, stop), within the holding period.
+        Days before a stock's first price count as 0, as in portfolio_cash_flow().groupby('Date').sum()"""
+        start = self.start if start is None else max(start, self.start)
+        stop = self.end if stop is None else min(stop, self.end)
+        if isinstance(self.instrument, str):
+            return self.quantity * np.nan_to_num(get_price_index().daily_prices(self.instrument, start, stop))
+        curve = _bond_curve(self.instrument, self.end - self.start)
+        return self.quantity * curve[start - self.start:stop - self.start]
+
+
+def positions_values(positions, start: int, stop: int):
+    """Daily total value of positions on the calendar offsets [start, stop).
+    Every position covers a slice of the calendar, its values are added on that slice"""
+    values = np.zeros(max(stop - start, 0))
+    for position in positions:
+        first, last = max(position.start, start), min(position.end, stop)
+        if first < last:
+            values[first - start:last - start] += position.values(first, last)
+    return values
+
+
+def stock_values(holdings, start_date, end_date):
+    """Daily value on [start_date, end_date) of shares held over the whole period, one number per column
+    of the price panel. Days before a stock's first price count as 0"""
+    held = np.flatnonzero(holdings)
+    prices = get_price_index().daily_matrix(calendar.offset(start_date), calendar.offset(end_date), held)
+    values = prices @ holdings[held]
+    if np.isnan(values).any():
+        values = np.where(np.isnan(prices), 0, prices) @ holdings[held]
+    return values
+
+
+BondTerm = collections.namedtuple('BondTerm', ['rate', 'years', 'min_pv'])
+
+
 class Bonds(Investment):
     """All Bonds"""
+    terms = {'short': BondTerm(0.015, 2, 250), 'long': BondTerm(0.03, 5, 1000)}
 
+    @profiled('instruments')
     def __init__(self, pv, rate: float, start_date, end_date):
         super(Bonds, self).__init__(pv, start_date, end_date)
         self.rate = rate
-        self.rate_flow = pd.Series(itertools.repeat((1 + self.rate) ** (1 / 365) - 1, self.term.days))
-        self.rate_flow.iloc[0] = 0
-        cash_flow = pd.DataFrame({'Date': pd.date_range(self.start_date, end=self.end_date, freq="D", closed='left'),
-                                  'Value': (1 + self.rate_flow).cumprod() * self.pv})
-        self.cash_flow = cash_flow.set_index('Date')
+        self.curve = _bond_curve(self.rate, self.term.days)
+        self.position = Position(self.rate, self.pv, calendar.offset(self.start_date),
+                                 calendar.offset(self.start_date) + self.term.days)
+
+    @property
+    @profiled('cash flow')
+    def cash_flow(self):
+        """Daily value, scaled from the shared curve on first access"""
+        if self._cash_flow is None:
+            self._cash_flow = pd.DataFrame({'Value': self.curve * self.pv},
+                                           index=_daily_dates(self.start_date, self.end_date))
+        return self._cash_flow
+
+    @cash_flow.setter
+    def cash_flow(self, value):
+        self._cash_flow = value
+
+    @property
+    def final_value(self):
+        """Value on the last day, same as cash_flow.iloc[-1, 0]"""
+        return self.curve[-1] * self.pv
+
+    @property
+    def rate_flow(self):
+        """Daily rates, the first day earns nothing"""
+        rate_flow = pd.Series(itertools.repeat((1 + self.rate) ** (1 / 365) - 1, self.term.days))
+        rate_flow.iloc[0] = 0
+        return rate_flow
 
     @classmethod  # Call a bond as a short one. Ensure rate, min price and min period
     def short(cls, start_date,  pv=250):
-        if pv < 250:
+        if pv < cls.terms['short'].min_pv:
             raise ValueError('pv must be >= 250')
-        rate, end_date = 0.015, start_date + pd.DateOffset(years=2)
+        rate, end_date = cls.terms['short'].rate, start_date + pd.DateOffset(years=cls.terms['short'].years)
         bond = cls(pv, rate, start_date, end_date)
         return bond
 
     @classmethod  # Call a bond as a long one. Ensure rate, min price and min period
     def long(cls, start_date, pv=1000):
-        if pv < 1000:
+        if pv < cls.terms['long'].min_pv:
             raise ValueError('pv must be >= 1000')
-        rate, end_date = 0.03, start_date + pd.DateOffset(years=5)
+        rate, end_date = cls.terms['long'].rate, start_date + pd.DateOffset(years=cls.terms['long'].years)
         bond = cls(pv, rate, start_date, end_date)
         return bond
 
     def compound_rate(self, end_date):
         """Returns compound rate for a given date"""
-        total_days = (end_date - self.start_date).days
-        return round((1 + self.rate_flow.loc[self.rate_flow.index <= total_days]).prod() - 1, 4)
+        # Interest accrues daily from the second day up to the last day of the bond
+        total_days = max(min((end_date - self.start_date).days, self.term.days - 1), 0)
+        return round(self.curve[total_days] - 1, 4)
 
 
 class Stocks(Investment):
     """All stocks"""
     name = OneOfStock('name')
 
+    @profiled('instruments')
     def __init__(self, name, start_date, end_date, num_stocks: int = 1):
         self.name = name
         self.start_date = start_date
         self.end_date = end_date
         self.num_stocks = num_stocks
-        self.price = stocks_df.loc[(self.start_date - BDay(1)):self.end_date, self.name]
-        self.pv = self.price.iloc[0] * self.num_stocks
-        cash_flow = pd.DataFrame({}, index=pd.date_range(start=(self.start_date - BDay(1)),
-                                                         end=self.end_date, freq="D", closed='left'))
-        cash_flow = cash_flow.merge(pd.DataFrame({'Value': self.price * self.num_stocks}), how='outer',
-                                    right_on='Date', left_index=True)
-        self.cash_flow = cash_flow.set_index('Date').fillna(method='pad').loc[self.start_date:, ]
+        self.purchase_price = get_price_index().first(self.name, _previous_business_day(self.start_date),
+                                                      self.end_date)
+        self.pv = self.purchase_price * self.num_stocks
+        self.position = Position(self.name, self.num_stocks, calendar.offset(self.start_date),
+                                 calendar.offset(self.end_date))
+        self._cash_flow = None
+
+    @property
+    def price(self):
+        """Prices from the business day before start_date to end_date"""
+        return get_stocks_df().loc[(self.start_date - BDay(1)):self.end_date, self.name]
+
+    @property
+    @profiled('cash flow')
+    def cash_flow(self):
+        """Daily value, built on first access"""
+        if self._cash_flow is None:
+            cash_flow = pd.DataFrame({}, index=pd.date_range(start=(self.start_date - BDay(1)),
+                                                             end=self.end_date, freq="D", closed='left'))
+            cash_flow = cash_flow.merge(pd.DataFrame({'Value': self.price * self.num_stocks}), how='outer',
+                                        right_on='Date', left_index=True)
+            self._cash_flow = cash_flow.set_index('Date').fillna(method='pad').loc[self.start_date:, ]
+        return self._cash_flow
 
     def return_on_stock(self, end_date):
         """Returns return on stock in a given date"""
-        return self.price[self.price.index <= end_date].iloc[-1] / self.price.iloc[0] - 1
+        log_price = get_price_index().log_as_of(self.name, min(end_date, self.end_date))
+        return math.expm1(log_price - math.log(self.purchase_price))
 
     def get_price(self, end_date):
         """Returns the price in a given date"""
-        return self.price[self.price.index <= end_date].iloc[-1]
+        return get_price_index().as_of(self.name, min(end_date, self.end_date))
 
 # Investor is a named tuple if mode and budget as attributes
 
@@ -161,8 +979,10 @@ class Portfolio:
     mode = OneOfMode('mode')
     budget = Monetary('budget')
 
-    def __init__(self, investor: Investor, start_date, end_date, investment_weights: tuple = (75, 25)):
+    def __init__(self, investor: Investor, start_date, end_date, investment_weights: tuple = (75, 25), rng=None):
         self.investor = investor
+        # Generator of the allocation draws, seeded from the random module unless given
+        self.rng = np.random.default_rng(random.getrandbits(64)) if rng is None else rng
         self.budget = self.investor[1]
         self.start_date = start_date
         self.end_date = end_date
@@ -171,7 +991,40 @@ class Portfolio:
         self.mode = self.investor[0]
         self.investments = self.mode(self)
         self.invest_list = [(k, i) for k, i in self.investments.items()]
+        self.dates = _daily_dates(self.start_date, self.end_date)
+        self._values = None
+
+    @property
+    @profiled('cash flow')
+    def values(self):
+        """Daily portfolio value on self.dates as a NumPy array, aggregated once"""
+        if self._values is None:
+            # Sum of the positions on the calendar, same as portfolio_cash_flow().groupby('Date').sum()
+            holdings = self.holdings if self.mode is aggressive else None
+            if holdings is not None:  # Stocks held from start to end, a product with the price matrix
+                self._values = stock_values(holdings, self.start_date, self.end_date)
+            else:
+                self._values = positions_values([investment.position for investment in self.investments.values()],
+                                                calendar.offset(self.start_date), calendar.offset(self.end_date))
+        return self._values
 
+    @property
+    def holdings(self):
+        """Number of shares held per column of the price panel, or None if the portfolio holds bonds"""
+        if not all(isinstance(investment, Stocks) for investment in self.investments.values()):
+            return None
+        columns = get_price_index().columns
+        holdings = np.zeros(len(columns))
+        for investment in self.investments.values():
+            holdings[columns[investment.name]] += investment.num_stocks
+        return holdings
+
+    @property
+    def value_series(self):
+        """Daily portfolio value as a Series, same as portfolio_cash_flow().groupby('Date').sum().Value"""
+        return pd.Series(self.values, index=self.dates, name='Value')
+
+    @profiled('concatenation')
     def portfolio_cash_flow(self):
         investment_values = [self.investments[investment[0]].cash_flow for investment in self.invest_list]
         investment_keys = [investment[0] for investment in self.invest_list]
@@ -182,27 +1035,13 @@ class Portfolio:
 
 # Mode functions. Defensive and Aggressive just fill the dict with bonds and stocks respectively,
 # according with the type and values returned by accounting_investment().
+@profiled('allocation')
 def defensive(portfolio):
     """Builds a defensive portfolio"""
-    new_list = []
-    bonds = accounting_investment(portfolio)
-    investments = {key: getattr(Bonds, key)(start_date=portfolio.start_date, pv=bonds[key]) for key in bonds}
-    investments_list = [(k, i) for k, i in investments.items()]
-    end_dates = [(investments[investment[0]].end_date,
-                  investments[investment[0]].cash_flow.iloc[-1, 0]) for investment in investments_list]
-    for end_date in end_dates:
-        if end_date[0] < portfolio.end_date:
-            # Deal with overdue bonds.  Starts a recursive function to build a new portfolio with same mode
-            # and calculates the new budget as bond's final value + rest of old budget.
-            investor = Investor(portfolio.investor[0], end_date[1] + portfolio.budget)
-            new_port = Portfolio(investor, start_date=end_date[0],
-                                 end_date=portfolio.end_date)
-            new_list.extend([(k, i) for k, i in new_port.investments.items()])
-            portfolio.budget += new_port.budget
-    investments_2 = {k + '_' + str(math.trunc(random.random() * 100)): i for k, i in new_list}
-    return {**investments, **investments_2}
+    return _invest_with_rollover(portfolio, _defensive_tranche, rollover_at_end=False)
 
 
+@profiled('allocation')
 def aggressive(portfolio):
     """Builds an aggressive portfolio"""
     stocks = accounting_investment(portfolio)
@@ -210,136 +1049,1000 @@ def aggressive(portfolio):
                         num_stocks=stocks[key]) for key in stocks}
 
 
+@profiled('allocation')
 def mixed(portfolio):
     """builds a mixed portfolio"""
-    investments = {}
-    temp = []
+    return _invest_with_rollover(portfolio, _mixed_tranche, rollover_at_end=True)
+
+
+def _defensive_tranche(tranche):
+    """Bonds bought with the budget of a tranche"""
+    bonds = accounting_investment(tranche)
+    return {key: getattr(Bonds, key)(start_date=tranche.start_date, pv=bonds[key]) for key in bonds}
+
+
+def _mixed_tranche(tranche):
+    """Bonds and stocks bought with the budget of a tranche"""
     # while budget is enough to buy a short bond, randomly weighted choose bond or stock.
-    while portfolio.budget >= Bonds.short(start_date=portfolio.start_date).pv:
-        mode_function = random.choices([pick_stock(portfolio), pick_bond(portfolio)],
-                                       weights=portfolio.investment_weights)
-        try:  # if no bond or stock is bought just move on to the next
-            portfolio.budget += - mode_function[0][1]  # subtract the acquisition price from the budget
-            key = list(mode_function[0][0].keys())[0]
-            if key in investments:
-                investments[key] += mode_function[0][0][key]
-            else:
-                investments[key] = mode_function[0][0][key]
-        except TypeError:   # Skips when "pick stocks" doesn't returns a dict.
-            pass
+    stock_share = tranche.investment_weights[0] / sum(tranche.investment_weights)
+    investments = _sample_investments(tranche, stock_share, Bonds.terms['short'].min_pv)
     for key in investments:
         if key in {'short', 'long'}:
-            investments[key] = getattr(Bonds, key)(pv=investments[key], start_date=portfolio.start_date)
-            if investments[key].end_date <= portfolio.end_date:
-                budget = investments[key].cash_flow.iloc[-1, 0] + portfolio.budget
-                investor = Investor(portfolio.investor[0], budget)
-                new_port = Portfolio(investor, start_date=investments[key].end_date,
-                                     end_date=portfolio.end_date, investment_weights=portfolio.investment_weights)
-                temp.extend([(k, i) for k, i in new_port.investments.items()])
-                portfolio.budget += new_port.budget
-        elif key in tickers:
-            investments[key] = Stocks(key, start_date=portfolio.start_date, end_date=portfolio.end_date,
-                                      num_stocks=investments[key])
+            investments[key] = getattr(Bonds, key)(pv=investments[key], start_date=tranche.start_date)
         else:
-            pass
-    investments2 = {k + '_' + str(math.trunc(random.random() * 100)): i for k, i in temp}
-    return {**investments, **investments2}
+            investments[key] = Stocks(key, start_date=tranche.start_date, end_date=tranche.end_date,
+                                      num_stocks=investments[key])
+    return investments
+
+
+class _Tranche:
+    """Budget invested on a date by a portfolio, first its own budget and then each matured bond.
+    Has the attributes read by accounting_investment, pick_stock and pick_bond"""
+    __slots__ = ('mode', 'budget', 'start_date', 'end_date', 'investment_weights', 'rng')
+
+    def __init__(self, portfolio, budget, start_date):
+        self.mode = portfolio.mode
+        self.rng = portfolio.rng
+        self.budget = budget
+        self.start_date = start_date
+        self.end_date = portfolio.end_date
+        self.investment_weights = portfolio.investment_weights
+
+
+def _invest_with_rollover(portfolio, invest, rollover_at_end):
+    """Invests the portfolio budget, then reinvests every bond maturing before the portfolio ends.
+
+    Maturities wait on a priority queue and are processed in date order, without recursion. Positions
+    of the n-th reinvestment go to the same flat dict, keyed '<investment>_<n>'. The cash left by a
+    tranche is reinvested once, with its first maturing bond; portfolio.budget ends as the cash never
+    reinvested.
+    """
+    investments = {}
+    cash = 0
+    maturities = [(portfolio.start_date, 0, portfolio.budget)]  # (date, tranche number, budget)
+    scheduled = 0
+    while maturities:
+        start_date, number, budget = heapq.heappop(maturities)
+        tranche = _Tranche(portfolio, budget, start_date)
+        rolled = []
+        for key, investment in invest(tranche).items():
+            investments[key if number == 0 else f'{key}_{number}'] = investment
+            if isinstance(investment, Bonds) and (investment.end_date < portfolio.end_date or
+                                                  (rollover_at_end and investment.end_date == portfolio.end_date)):
+                rolled.append(investment)
+        rolled.sort(key=lambda bond: bond.end_date)
+        for bond in rolled:
+            # The bond's last value is reinvested on maturity, the first one takes the cash left by the tranche
+            scheduled += 1
+            heapq.heappush(maturities, (bond.end_date, scheduled, bond.final_value + tranche.budget))
+            tranche.budget = 0
+        cash += tranche.budget
+    portfolio.budget = cash
+    return investments
 
 
 # Functions for mode
+@profiled('allocation')
 def pick_bond(portfolio):
-    """Randomly picks a bond"""
-    # budget is enough to buy a long bond, randomly choose one.
-    if portfolio.budget >= Bonds.long(start_date=portfolio.start_date).pv:
-        bond_type = random.choice(['long', 'short'])
-        value = getattr(Bonds, bond_type)(start_date=portfolio.start_date).pv
-        return {bond_type: value}, value
-    # budget is enough to buy a short bond, buy all budget.
-    else:
-        bond_type = 'short'
-        value = portfolio.budget
-        return {bond_type: value}, value
+    """Randomly picks a bond: one draw of the bond sampler. Returns ({bond type: pv}, cost), None if
+    the budget is below the short bond minimum. The portfolio budget is left as it is"""
+    tranche = _Tranche(portfolio, portfolio.budget, portfolio.start_date)
+    bonds = _sample_bonds(tranche, draws=1)
+    if bonds:
+        return bonds, portfolio.budget - tranche.budget
 
 
+@profiled('allocation')
 def pick_stock(portfolio):
-    """Randomly picks a stock"""
-    stock = random.choice(tickers)
-    try:
-        price = Stocks(name=stock, start_date=portfolio.start_date, end_date=portfolio.end_date).pv
-        max_num_stocks = int(portfolio.budget / price)
-        # Exception when the range date doesn't allow pick a stock. when Bonds due in the last few days of a portfolio.
-    except KeyError:
-        max_num_stocks = 0
-    if max_num_stocks < 1:
-        pass
-    else:
-        amount = random.randint(1, max_num_stocks)
-        return {stock: amount}, amount * price
+    """Randomly picks a stock: one draw of the stock sampler. Returns ({ticker: shares}, cost), None if
+    the drawn stock is unaffordable. The portfolio budget is left as it is"""
+    tranche = _Tranche(portfolio, portfolio.budget, portfolio.start_date)
+    stocks = _sample_investments(tranche, 1, 0, draws=1)
+    if stocks:
+        return stocks, portfolio.budget - tranche.budget
 
 
+@profiled('allocation')
 def accounting_investment(portfolio):
     """Accounts bonds or stocks"""
-    investments = {}
     if portfolio.mode is defensive:
-        min_budget = Bonds.short(start_date=portfolio.start_date).pv
-        function = pick_bond
-    else:
-        min_budget = 100
-        function = pick_stock
-    while portfolio.budget >= min_budget:
-        invest = function(portfolio)
-        try:  # if no bond or stock is bought just move on to the next
-            key = list(invest[0].keys())[0]
-            portfolio.budget += - invest[1]
-            if key in investments:
-                investments[key] += invest[0][key]
-            else:
-                investments[key] = invest[0][key]
-        except TypeError:   # Skips when "pick stocks" doesn't returns a dict.
+        return _sample_bonds(portfolio)
+    return _sample_investments(portfolio, 1, 100)
+
+
+# Batched samplers. Until the budget runs out they draw a bond (long or short at its minimum price
+# while the budget allows a long one, then a short one with the rest) or a stock (a ticker of the
+# universe and a uniform amount it can afford), taking their random numbers by blocks from the
+# generator of the portfolio.
+_block = 64
+
+
+_below_one = 1 - 2 ** -53  # 1 - u can be 1, uniforms stay in [0, 1)
+_n_strata = 64  # paths stratified together
+
+
+class _MirroredGenerator:
+    """Draws 1 - u of a generator: the antithetic partner of the portfolio drawing from it"""
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def random(self, size=None):
+        return np.minimum(1 - self.rng.random(size), _below_one)
+
+
+class _StratifiedGenerator:
+    """Draws from a generator, the first uniform of each row falling in the given strata of [0, 1)"""
+
+    def __init__(self, rng, strata, n_strata):
+        self.rng = rng
+        self.strata = strata
+        self.n_strata = n_strata
+
+    def random(self, size=None):
+        u = self.rng.random(size)
+        if self.strata is not None:
+            first = u[:, 0] if u.ndim == 2 else u[:1]
+            first[:] = (self.strata[:len(first)] + first) / self.n_strata
+            self.strata = None
+        return u
+
+
+def seed(value=None):
+    """Seeds the random draws of portfolios. Same as random.seed: portfolios built without a generator
+    seed theirs from the random module"""
+    random.seed(value)
+
+
+def _sample_bonds(portfolio, draws=None):
+    """Bonds until the budget is below the short bond minimum: a long or short bond at its minimum
+    price while the budget allows a long one, then a short one with the rest. At most draws bonds if given"""
+    short_min, long_min = Bonds.terms['short'].min_pv, Bonds.terms['long'].min_pv
+    investments = {}
+    budget = portfolio.budget
+    remaining = math.inf if draws is None else draws
+    while budget >= long_min and remaining > 0:
+        # Every draw costs at least short_min, so at most this many happen before budget < long_min
+        is_long = portfolio.rng.random(int(min((budget - long_min) // short_min + 1, 1024, remaining))) < 0.5
+        spent = np.cumsum(np.where(is_long, long_min, short_min))
+        # Draw k happens while the budget left before it is still >= long_min
+        count = 1 + np.count_nonzero(budget - spent[:-1] >= long_min)
+        longs = int(np.count_nonzero(is_long[:count]))
+        numbers = {'long': longs, 'short': count - longs}
+        for key in (('long', 'short') if is_long[0] else ('short', 'long')):  # in the order first bought
+            if numbers[key]:
+                investments[key] = investments.get(key, 0) + numbers[key] * Bonds.terms[key].min_pv
+        budget -= spent[count - 1]
+        remaining -= count
+    if short_min <= budget < long_min and remaining > 0:
+        investments['short'] = investments.get('short', 0) + budget
+        budget = 0
+    portfolio.budget = float(budget)
+    return investments
+
+
+@functools.lru_cache(maxsize=256)
+def _stock_prices(source, universe, start_date, end_date):
+    """Price a portfolio pays for each ticker of a universe (NaN where none can be bought) and the
+    cheapest one that can be drawn"""
+    index = source.index
+    start = _previous_business_day(start_date)
+    prices = np.full(len(universe), np.nan)
+    for i, ticker in enumerate(universe):
+        try:
+            prices[i] = index.first(ticker, start, end_date)
+        except KeyError:
             pass
+    prices.flags.writeable = False
+    drawn = prices[np.isfinite(prices) if universe.weights is None else
+                   np.isfinite(prices) & (np.array(universe.weights) > 0)]
+    return prices, drawn.min() if drawn.size else np.inf
+
+
+def _sample_investments(portfolio, stock_share, min_budget, draws=None):
+    """Draws a stock with probability stock_share, a bond otherwise, until the budget is below
+    min_budget (or draws times if given). Returns {ticker or bond type: shares or pv}"""
+    long_min = Bonds.terms['long'].min_pv
+    universe = get_universe()
+    prices, cheapest = _stock_prices(get_price_source(), universe, portfolio.start_date, portfolio.end_date)
+    if stock_share == 1:
+        # No stock can be bought below the cheapest price that can be drawn, the loop would not end
+        min_budget = max(min_budget, cheapest)
+    cumulative = None if universe.cumulative is None else np.array(universe.cumulative)
+    investments = {}
+    budget = portfolio.budget
+    remaining = math.inf if draws is None else draws
+    while budget >= min_budget and remaining > 0:
+        u = portfolio.rng.random((3, int(min(_block, remaining))))
+        remaining -= u.shape[1]
+        if cumulative is None:
+            ticker = np.minimum((u[1] * len(universe)).astype(int), len(universe) - 1)
+        else:
+            ticker = np.minimum(cumulative.searchsorted(u[1] * cumulative[-1], side='right'), len(universe) - 1)
+        # The block is drawn at once, only the budget bookkeeping is left to the loop
+        is_stock = (u[0] < stock_share).tolist()
+        for stock, i, price, u_bond, u_amount in zip(is_stock, ticker.tolist(), prices[ticker].tolist(),
+                                                     u[1].tolist(), u[2].tolist()):
+            if stock:
+                if not price <= budget:  # unaffordable, or no price on the dates (NaN)
+                    continue
+                key = universe.tickers[i]
+                value = 1 + int(u_amount * int(budget / price))
+                budget -= value * price
+            elif budget >= long_min:
+                key = 'long' if u_bond < 0.5 else 'short'
+                value = Bonds.terms[key].min_pv
+                budget -= value
+            else:
+                key, value, budget = 'short', budget, 0
+            investments[key] = investments.get(key, 0) + value
+            if budget < min_budget:
+                break
+    portfolio.budget = budget
     return investments
 
 
 # Working on simulations
+class GroupStatistics:
+    """Running statistics of a portfolio group. Portfolios are added one at a time and not kept,
+    memory depends on the number of dates only"""
+
+    def __init__(self, fields=('return_and_vol', 'monthly', 'yearly')):
+        self.fields = set(fields)
+        self.count = 0
+        self.sums = dict.fromkeys(['return', 'return_sq', 'vol', 'vol_sq'], 0)
+        # (start_date, end_date) -> [sums, counts] on the period ends of that date range
+        self.monthly = {}
+        self.yearly = {}
+
+    @profiled('aggregation')
+    def add(self, portfolio):
+        """Accumulates a portfolio"""
+        self.count += 1
+        values = portfolio.values
+        if 'return_and_vol' in self.fields:
+            return_on_portfolio = values[-1] / values[0] - 1
+            vol_on_portfolio = np.std(values[1:] / values[:-1] - 1, ddof=1)
+            self.sums['return'] += return_on_portfolio
+            self.sums['return_sq'] += return_on_portfolio ** 2
+            self.sums['vol'] += vol_on_portfolio
+            self.sums['vol_sq'] += vol_on_portfolio ** 2
+        if 'monthly' in self.fields or 'yearly' in self.fields:
+            key = (portfolio.start_date, portfolio.end_date)
+            periods = period_boundaries(*key)
+            if 'monthly' in self.fields:
+                self._bucket(self.monthly, key, gather_periods(values, periods.month_rows))
+            if 'yearly' in self.fields:
+                self._bucket(self.yearly, key, _period_returns(gather_periods(values, periods.year_rows)))
+        return self
+
+    def update(self, portfolios):
+        """Accumulates every portfolio of an iterable, e.g. a generator"""
+        for portfolio in portfolios:
+            self.add(portfolio)
+        return self
+
+    @staticmethod
+    def _bucket(buckets, key, values):
+        if key not in buckets:
+            buckets[key] = [np.zeros(len(values)), np.zeros(len(values))]
+        sums, counts = buckets[key]
+        known = ~np.isnan(values)
+        sums += np.where(known, values, 0)
+        counts += known
+
+    @staticmethod
+    def _bucket_mean(buckets, field):
+        """Mean per period end over every date range, as a DataFrame indexed by Date"""
+        sums, counts = pd.Series(dtype=float), pd.Series(dtype=float)
+        for (start_date, end_date), (range_sums, range_counts) in buckets.items():
+            ends = getattr(period_boundaries(start_date, end_date), field)
+            sums = sums.add(pd.Series(range_sums, index=ends), fill_value=0)
+            counts = counts.add(pd.Series(range_counts, index=ends), fill_value=0)
+        return (sums / counts.where(counts > 0)).rename('Value').rename_axis('Date').to_frame()
+
+    def _mean(self, key):
+        return self.sums[key] / self.count
+
+    def _standard_error(self, key):
+        variance = (self.sums[key + '_sq'] - self.count * self._mean(key) ** 2) / (self.count - 1)
+        return math.sqrt(max(variance, 0) / self.count)
+
+    @property
+    def mean_return(self):
+        return self._mean('return')
+
+    @property
+    def mean_vol(self):
+        return self._mean('vol')
+
+    @property
+    def return_standard_error(self):
+        return self._standard_error('return')
+
+    @property
+    def vol_standard_error(self):
+        return self._standard_error('vol')
+
+    def monthly_mean(self):
+        """Mean monthly value, as a DataFrame indexed by Date"""
+        return self._bucket_mean(self.monthly, 'month_ends')
+
+    def yearly_mean(self):
+        """Mean yearly return, as a DataFrame indexed by Date"""
+        return self._bucket_mean(self.yearly, 'year_ends')
+
+
+def _group_statistics(portfolio_lists, fields):
+    return [GroupStatistics(fields).update(group) for group in portfolio_lists]
+
+
+def _return_and_vol_table(statistics, lists_names):
+    return_on_group = {name: (round(stats.mean_return, 4), round(stats.mean_vol, 4))
+                       for name, stats in zip(lists_names, statistics)}
+    return pd.DataFrame(return_on_group, index=['Investment return', 'daily volatility'])
+
+
+def _group_table(frames, lists_names):
+    return pd.concat(frames, keys=lists_names, names=['Portfolio_group', 'Date']).reset_index(level='Date')
+
+
+@profiled('aggregation')
 def return_and_vol_on_portfolios(portfolio_lists: list, lists_names: list):
     """Computes mean return and the mean volatility for each portfolios group"""
-    i = 0
-    return_on_group = {}
-    for group in portfolio_lists:
-        return_on_portfolio = [(p.portfolio_cash_flow().groupby('Date').sum().Value[-1] /
-                               p.portfolio_cash_flow().groupby('Date').sum().Value[0]) - 1 for p in group]
-        vol_on_portfolio = [p.portfolio_cash_flow().groupby('Date').sum().pct_change().std().Value for p in group]
-        mean_return_portfolio = sum(return_on_portfolio) / len(return_on_portfolio)
-        mean_vol_portfolio = sum(vol_on_portfolio) / len(vol_on_portfolio)
-        return_on_group[lists_names[i]] = (round(mean_return_portfolio, 4), round(mean_vol_portfolio, 4))
-        i += 1
-    return pd.DataFrame(return_on_group, index=['Investment return', 'daily volatility'])
+    return _return_and_vol_table(_group_statistics(portfolio_lists, ['return_and_vol']), lists_names)
 
 
+@profiled('aggregation')
 def mean_monthly_value_on_portfolios(portfolio_lists: list, lists_names: list):
     """Calculates the mean monthly values for each portfolio group"""
-    list_cash_flows = []
-    for group in portfolio_lists:
-        cash_flows = [p.portfolio_cash_flow().groupby(['Date']).sum().resample('M').asfreq() for p in group]
-        keys = [p for p in group]
-        group_cash_flow = pd.concat(cash_flows, keys=keys,
-                                    names=['Portfolio', 'Date']).reset_index(level='Date') \
-            .groupby(['Date']).mean()
-        list_cash_flows.append(group_cash_flow)
-    return pd.concat(list_cash_flows, keys=lists_names,
-                     names=['Portfolio_group', 'Date']).reset_index(level='Date')
+    statistics = _group_statistics(portfolio_lists, ['monthly'])
+    return _group_table([stats.monthly_mean() for stats in statistics], lists_names)
 
 
+@profiled('aggregation')
 def mean_yearly_return_on_portfolios(portfolio_lists: list, lists_names: list):
     """Calculates the mean yearly return for each portfolio group"""
-    list_cash_flows = []
-    for group in portfolio_lists:
-        cash_flows = [p.portfolio_cash_flow().groupby(['Date']).sum().resample('Y')
-                      .asfreq().pct_change() for p in group]
-        keys = [p for p in group]
-        group_cash_flow = pd.concat(cash_flows, keys=keys,
-                                    names=['Portfolio', 'Date']).reset_index(level='Date') \
-            .groupby(['Date']).mean()
-        list_cash_flows.append(group_cash_flow)
-    return pd.concat(list_cash_flows, keys=lists_names,
-                     names=['Portfolio_group', 'Date']).reset_index(level='Date')
+    statistics = _group_statistics(portfolio_lists, ['yearly'])
+    return _group_table([stats.yearly_mean() for stats in statistics], lists_names)
+
+
+@profiled('aggregation')
+def statistics_on_portfolios(portfolio_lists: list, lists_names: list):
+    """Streams each group once (groups can be generators) and returns the outputs of
+    return_and_vol_on_portfolios, mean_monthly_value_on_portfolios and mean_yearly_return_on_portfolios"""
+    return tables_on_statistics(_group_statistics(portfolio_lists, ['return_and_vol', 'monthly', 'yearly']),
+                                lists_names)
+
+
+def tables_on_statistics(statistics: list, lists_names: list):
+    """The three group tables from GroupStatistics already accumulated, e.g. kept between runs"""
+    return (_return_and_vol_table(statistics, lists_names),
+            _group_table([stats.monthly_mean() for stats in statistics], lists_names),
+            _group_table([stats.yearly_mean() for stats in statistics], lists_names))
+
+
+# Parallel simulations. Portfolio i draws from its own random stream, spawned from the seed, so a seed
+# gives the same portfolios whatever the number of workers.
+@profiled('simulation')
+def run_simulations(investor: Investor, n: int, start_date, end_date, investment_weights: tuple = (75, 25),
+                    workers: int = None, seed=None, first: int = 0, sampling=None):
+    """Builds n portfolios of an investor across a pool of worker processes.
+    first is the index of the first portfolio: with the same seed, first=n extends a run of n portfolios.
+    sampling reduces the variance of the draws: 'antithetic' (portfolio 2i + 1 mirrors the draws of
+    portfolio 2i) or 'stratified' (the first draws of every 64 portfolios are spread over 64 strata)"""
+    _sampling_group(sampling)
+    workers = os.cpu_count() if workers is None else workers
+    with _worker_pool(workers if n > 1 else 1) as pool:
+        return _run_portfolios(pool, workers, investor, n, start_date, end_date, investment_weights, seed, first,
+                               sampling)
+
+
+@contextlib.contextmanager
+def _worker_pool(workers):
+    """Process pool for _run_portfolios, None for a single worker. Workers map the price panel from a
+    temporary cache instead of loading or receiving a copy"""
+    if workers <= 1:
+        yield None
+        return
+    cache = tempfile.mkdtemp(prefix='invsim_prices_')
+    try:
+        prices = get_stocks_df()
+        write_price_cache(cache, prices, prices.index[0], prices.index[-1])
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                    initargs=(cache, _universe)) as pool:
+            yield pool
+    finally:
+        shutil.rmtree(cache, ignore_errors=True)
+
+
+def _run_portfolios(pool, workers, investor, n, start_date, end_date, investment_weights, seed, first, sampling):
+    """run_simulations on an open _worker_pool"""
+    args = (investor, start_date, end_date, investment_weights, np.random.SeedSequence(seed).entropy, sampling)
+    if pool is None or n <= 1:
+        return _build_portfolios(range(first, first + n), *args)
+    chunk = -(-n // (workers * 4))
+    chunks = [range(i, min(i + chunk, first + n)) for i in range(first, first + n, chunk)]
+    parts = pool.map(_build_portfolios, chunks, *[[arg] * len(chunks) for arg in args])
+    return [portfolio for part in parts for portfolio in part]
+
+
+ConvergedRun = collections.namedtuple('ConvergedRun', ['statistics', 'return_standard_error', 'vol_standard_error'])
+
+
+@profiled('simulation')
+def run_until(investor: Investor, start_date, end_date, target_se: float, batch: int = 100,
+              max_portfolios: int = 10000, investment_weights: tuple = (75, 25), workers: int = None, seed=None,
+              sampling=None):
+    """Builds portfolios by batches until the standard errors of the mean return and of the mean daily
+    volatility are both below target_se, or max_portfolios are built. Portfolios are not kept: returns
+    a ConvergedRun with the GroupStatistics of all of them (see tables_on_statistics) and the standard
+    errors the stopping rule used. With sampling they are computed on pairs or strata groups, the
+    GroupStatistics ones assume independent portfolios"""
+    group = _sampling_group(sampling)
+    batch = -(-batch // group) * group  # pairs and strata groups stay in the same batch
+    seed = np.random.SeedSequence(seed).entropy  # every batch extends the same run
+    workers = os.cpu_count() if workers is None else workers
+    statistics = GroupStatistics()
+    returns, vol = [], []
+    errors = (np.inf, np.inf)
+    with _worker_pool(workers) as pool:  # one pool and price cache for every batch
+        while statistics.count < max_portfolios:
+            for portfolio in _run_portfolios(pool, workers, investor, min(batch, max_portfolios - statistics.count),
+                                             start_date, end_date, investment_weights, seed, statistics.count,
+                                             sampling):
+                statistics.add(portfolio)
+                path_return, path_vol = _returns_and_vol(portfolio.values[None])
+                returns.append(path_return[0])
+                vol.append(path_vol[0])
+            errors = _standard_errors(returns, vol, group)
+            if max(errors) < target_se:
+                break
+    return ConvergedRun(statistics, *errors)
+
+
+def _init_worker(cache, universe):
+    set_price_source(CachedSource(cache))
+    set_universe(universe)
+
+
+def _build_portfolios(indices, investor, start_date, end_date, investment_weights, entropy, sampling=None):
+    """Builds the portfolios of the given indices, each one drawing from its own spawned stream"""
+    portfolios = []
+    for i in indices:
+        stream = np.random.SeedSequence(entropy, spawn_key=(i,))
+        if sampling == 'antithetic' and i % 2:
+            rng = _MirroredGenerator(np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(i - 1,))))
+        elif sampling == 'stratified':
+            # Strata of the portfolio in its group of _n_strata, from a shuffle seeded by the group
+            shuffle = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(i // _n_strata, 0)))
+            strata = shuffle.permuted(np.tile(np.arange(_n_strata), (3, 1)), axis=1)[:, i % _n_strata]
+            rng = _StratifiedGenerator(np.random.default_rng(stream), strata, _n_strata)
+        else:
+            rng = np.random.default_rng(stream)
+        portfolios.append(Portfolio(investor, start_date=start_date, end_date=end_date,
+                                    investment_weights=investment_weights, rng=rng))
+    return portfolios
+
+
+# Vectorized simulations. Draws the allocations of many investors at once with NumPy, following the
+# rules of defensive, aggressive and mixed, and values every path against a single price matrix.
+
+Simulation = collections.namedtuple('Simulation', ['dates', 'values', 'allocations', 'params'])
+
+
+def _universe_columns():
+    """Column numbers on the price panel of the tickers of the universe"""
+    if _universe is None:
+        return None
+    columns = get_price_index().columns
+    return [columns[ticker] for ticker in _universe]
+
+
+def _price_matrix(start_date, end_date, columns=None):
+    """Daily dates on [start_date, end_date) and as-of prices for them (padded as Stocks.cash_flow).
+    The matrix is shared by the runs over the same dates and is read only"""
+    return _shared_price_matrix(get_price_source(), calendar.offset(start_date), calendar.offset(end_date),
+                                None if columns is None else tuple(columns))
+
+
+@functools.lru_cache(maxsize=4)
+def _shared_price_matrix(source, start, stop, columns):
+    matrix = np.nan_to_num(source.index.daily_matrix(start, stop, None if columns is None else list(columns)))
+    matrix.flags.writeable = False
+    return calendar.dates(start, stop), matrix
+
+
+def _purchase_prices(date, end_date, columns=None):
+    """Prices paid for stocks bought on date (as Stocks.pv), NaN where no stock can be bought"""
+    trading = get_price_index().trading
+    i = trading.searchsorted(calendar.offset(_previous_business_day(date)))
+    prices = get_stocks_df().values
+    if i == len(trading) or trading[i] > calendar.offset(end_date):
+        return np.full(prices.shape[1] if columns is None else len(columns), np.nan)
+    return prices[i] if columns is None else prices[i, columns]
+
+
+def _uniforms(rng, ids, sampling=None):
+    """(3, len(ids)) uniforms for an allocation round of the paths ids.
+    antithetic: path 2i + 1 takes 1 - u of path 2i while both are still investing.
+    stratified: in each group of _n_strata path ids, each of the 3 uniforms has one draw per stratum
+    of [0, 1), shuffled across the paths of the group"""
+    u = rng.random((3, len(ids)))
+    if sampling == 'antithetic':
+        paired = np.flatnonzero((ids[1:] == ids[:-1] + 1) & (ids[1:] % 2 == 1))
+        u[:, paired + 1] = np.minimum(1 - u[:, paired], _below_one)
+    elif sampling == 'stratified':
+        group = ids // _n_strata
+        for row in u:
+            # Random order within each group, the rank of a path in it is its stratum
+            order = np.lexsort((rng.random(len(ids)), group))
+            sorted_group = group[order]
+            first = np.searchsorted(sorted_group, sorted_group, side='left')
+            stratum, strata = np.empty(len(ids)), np.empty(len(ids))
+            stratum[order] = np.arange(len(ids)) - first
+            strata[order] = np.searchsorted(sorted_group, sorted_group, side='right') - first
+            row[:] = (stratum + row) / strata
+    elif sampling is not None:
+        raise ValueError("sampling must be None, 'antithetic' or 'stratified'")
+    return u
+
+
+def _allocate(mode, budgets, prices, investment_weights, rng, cumulative=None, ids=None, sampling=None):
+    """Allocates each budget following the mode rules. Returns shares, bonds pv (short, long) and cash.
+    prices is one price per ticker, or one row of prices per budget (budgets invested on different
+    dates). Tickers are drawn uniformly, or by the cumulative weights of a universe. ids are the path
+    ids of the budgets, used to pair antithetic paths (see _uniforms)"""
+    budget = np.array(budgets, dtype=float)
+    per_row = np.ndim(prices) == 2
+    n_tickers = np.shape(prices)[-1]
+    shares = np.zeros((len(budget), n_tickers))
+    bonds = np.zeros((len(budget), 2))
+    short_min, long_min = Bonds.terms['short'].min_pv, Bonds.terms['long'].min_pv
+    if mode is defensive:
+        stock_share, min_budget = 0, short_min
+    elif mode is aggressive:
+        stock_share, min_budget = 1, 100
+        # No stock can be bought below the cheapest price that can be drawn, the loop would not end
+        drawn = prices if cumulative is None else prices[..., np.diff(cumulative, prepend=0) > 0]
+        cheapest = np.where(np.isfinite(drawn), drawn, np.inf).min(axis=-1, initial=np.inf)
+        min_budget = np.maximum(min_budget, cheapest)
+    else:
+        stock_share, min_budget = investment_weights[0] / sum(investment_weights), short_min
+    min_budget = np.broadcast_to(min_budget, budget.shape)
+    active = np.flatnonzero(budget >= min_budget)
+    while active.size:
+        b = budget[active]
+        u = _uniforms(rng, active if ids is None else ids[active], sampling)
+        is_stock = u[0] < stock_share
+        # Stock: uniform ticker, uniform amount in [1, budget / price], skipped if unaffordable
+        if cumulative is None:
+            ticker = np.minimum((u[1] * n_tickers).astype(int), n_tickers - 1)
+        else:
+            ticker = np.minimum(cumulative.searchsorted(u[1] * cumulative[-1], side='right'), n_tickers - 1)
+        price = prices[active, ticker] if per_row else prices[ticker]
+        with np.errstate(invalid='ignore'):
+            max_num = np.where(np.isfinite(price), np.floor(b / np.where(np.isfinite(price), price, 1)), 0)
+        buy = is_stock & (max_num >= 1)
+        amount = 1 + np.floor(u[2] * max_num)
+        np.add.at(shares, (active[buy], ticker[buy]), amount[buy])
+        cost = np.where(buy, amount * np.where(buy, price, 0), 0)
+        # Bond: long or short at min price while budget >= long min, otherwise all in short
+        is_bond = ~is_stock
+        long = is_bond & (b >= long_min) & (u[1] < 0.5)
+        short = is_bond & (b >= long_min) & ~long
+        rest = is_bond & (b < long_min)
+        bonds[active[long], 1] += long_min
+        bonds[active[short], 0] += short_min
+        bonds[active[rest], 0] += b[rest]
+        cost += long * long_min + short * short_min + np.where(rest, b, 0)
+        budget[active] = b - cost
+        active = active[budget[active] >= min_budget[active]]
+    return shares, bonds, budget
+
+
+@profiled('simulation')
+def simulate(mode, budgets, start_date, end_date, n_paths=None, seed=None,
+             investment_weights: tuple = (75, 25), sampling=None):
+    """Simulates n_paths portfolios of a mode at once. Budgets is a number or one budget per path.
+
+    Matured bonds are reinvested with the same mode, as Portfolio does. sampling reduces the variance
+    of the draws: 'antithetic' (paths 2i and 2i + 1 mirror each other) or 'stratified'. Returns a
+    Simulation with the daily dates, the (paths x dates) value matrix, the first allocation of each
+    path and the parameters.
+    """
+    if mode not in {defensive, aggressive, mixed}:
+        raise ValueError("mode must be on of defensive, aggressive, mixed")
+    budgets = np.asarray(budgets, dtype=float)
+    n_paths = budgets.size if n_paths is None else n_paths
+    budgets = np.broadcast_to(budgets, (n_paths,))
+    if (budgets < 0).any():
+        raise ValueError('budgets must be >= 0')
+    rng = np.random.default_rng(seed)
+    # Stocks are drawn from the universe, the matrices only hold its columns
+    universe = get_universe()
+    columns = _universe_columns()
+    cumulative = None if universe.cumulative is None else np.array(universe.cumulative)
+    dates, matrix = _price_matrix(start_date, end_date, columns)
+    values = np.empty((n_paths, len(dates)))
+    allocations = None
+    # Maturity date -> list of (path ids, budgets) reinvested on that date
+    events = {pd.Timestamp(start_date): [(np.arange(n_paths), budgets)]}
+    while events:
+        date = min(events)
+        paths = np.concatenate([path for path, _ in events[date]])
+        budget = np.concatenate([budget for _, budget in events.pop(date)])
+        shares, bonds, cash = _allocate(mode, budget, _purchase_prices(date, end_date, columns),
+                                        investment_weights, rng, cumulative, paths, sampling)
+        if allocations is None:
+            allocations = {'budget': budgets.copy(), 'shares': shares, 'short': bonds[:, 0],
+                           'long': bonds[:, 1], 'cash': cash}
+        cash = cash.copy()  # cash left on each path, reinvested with its first maturing bond
+        offset = (date - dates[0]).days
+        if offset == 0:
+            # First allocation of every path, the price product fills the matrix without a temporary
+            np.matmul(shares, matrix.T, out=values)
+        elif shares.any():
+            held = np.zeros((n_paths, shares.shape[1]))
+            np.add.at(held, paths, shares)
+            values[:, offset:] += held @ matrix[offset:].T
+        for column, kind in enumerate(['short', 'long']):
+            if not bonds[:, column].any():
+                continue
+            rate, years, _ = Bonds.terms[kind]
+            maturity = date + pd.DateOffset(years=years)
+            curve = _bond_curve(rate, (maturity - date).days)
+            stop = min(offset + len(curve), len(dates))
+            values[:, offset:stop] += np.outer(np.bincount(paths, bonds[:, column], minlength=n_paths),
+                                               curve[:stop - offset])
+            if maturity < end_date:
+                # The bond last value is reinvested, with the cash left if the short bond didn't take it,
+                # as defensive and mixed do
+                rolled = bonds[:, column] > 0
+                events.setdefault(maturity, []).append((paths[rolled],
+                                                        bonds[rolled, column] * curve[-1] + cash[rolled]))
+                cash[rolled] = 0
+    params = {'mode': mode.__name__, 'n_paths': n_paths, 'start_date': pd.Timestamp(start_date),
+              'end_date': pd.Timestamp(end_date), 'seed': seed, 'investment_weights': tuple(investment_weights),
+              'tickers': list(universe.tickers), 'sampling': sampling}
+    return Simulation(dates, values, allocations, params)
+
+
+def _returns_and_vol(values):
+    """Return and daily volatility of every path of a value matrix. Paths without value (e.g. no budget)
+    give NaN, the group means skip them"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values[:, -1] / values[:, 0] - 1, np.std(values[:, 1:] / values[:, :-1] - 1, axis=1, ddof=1)
+
+
+def _sampling_group(sampling):
+    """Number of consecutive paths drawn together: the means of these groups are independent draws"""
+    groups = {None: 1, 'antithetic': 2, 'stratified': _n_strata}
+    if sampling not in groups:
+        raise ValueError("sampling must be None, 'antithetic' or 'stratified'")
+    return groups[sampling]
+
+
+def _standard_errors(returns, vol, group=1):
+    """Standard errors of the mean return and mean volatility, from the means of groups of consecutive
+    paths (antithetic pairs or strata groups are not independent paths). Infinite under 10 groups"""
+    n = len(returns) // group * group
+    returns, vol = (np.asarray(x[:n], dtype=float).reshape(-1, group) for x in (returns, vol))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # groups of paths without values
+        returns, vol = np.nanmean(returns, axis=1), np.nanmean(vol, axis=1)
+    if len(returns) < 10:
+        return np.inf, np.inf
+    return tuple(np.nanstd(x, ddof=1) / math.sqrt(np.isfinite(x).sum()) for x in (returns, vol))
+
+
+@profiled('simulation')
+def simulate_until(mode, budgets, start_date, end_date, target_se: float, batch: int = 1000,
+                   max_paths: int = 100000, seed=None, investment_weights: tuple = (75, 25), sampling=None):
+    """Simulates batches of paths with a budget until the standard errors of the mean return and of the
+    mean daily volatility are both below target_se, or max_paths are simulated. Returns the Simulation
+    of all paths, the standard errors the stopping rule used are in its params"""
+    group = _sampling_group(sampling)
+    batch = -(-batch // group) * group  # pairs and strata groups stay in the same batch
+    streams = np.random.SeedSequence(seed)
+    parts, returns, vol = [], np.empty(0), np.empty(0)
+    while len(returns) < max_paths:
+        parts.append(simulate(mode, budgets, start_date, end_date, min(batch, max_paths - len(returns)),
+                              seed=streams.spawn(1)[0], investment_weights=investment_weights, sampling=sampling))
+        returns, vol = (np.concatenate(pair) for pair in zip((returns, vol), _returns_and_vol(parts[-1].values)))
+        errors = _standard_errors(returns, vol, group)
+        if max(errors) < target_se:
+            break
+    values = np.concatenate([part.values for part in parts])
+    allocations = {key: np.concatenate([part.allocations[key] for part in parts]) for key in parts[0].allocations}
+    params = dict(parts[0].params, n_paths=len(values), seed=seed, target_se=target_se,
+                  return_standard_error=float(errors[0]), vol_standard_error=float(errors[1]))
+    return Simulation(parts[0].dates, values, allocations, params)
+
+
+def _row_chunks(values, size=4096):
+    """Row blocks of a value matrix, so memory-mapped results are read a block at a time"""
+    for first in range(0, len(values), size):
+        yield np.asarray(values[first:first + size])
+
+
+# Rolling-start backtests. Every entry date invests the same way for a fixed horizon of days. All
+# entries are allocated at once, their values are sliding windows over one price matrix and the
+# bond curves, and matured bonds of every entry are reinvested together.
+
+Backtest = collections.namedtuple('Backtest', ['entry_dates', 'values', 'allocations', 'params'])
+
+
+def _purchase_price_rows(offsets, end_offsets, columns=None):
+    """_purchase_prices for one calendar offset (and end offset) per row"""
+    trading = get_price_index().trading
+    weekday = (offsets + calendar.origin.weekday()) % 7
+    previous = offsets - np.select([weekday == 0, weekday == 6], [3, 2], 1)  # as _previous_business_day
+    i = np.minimum(trading.searchsorted(previous), len(trading) - 1)
+    prices = get_stocks_df().values[i]
+    prices = np.array(prices if columns is None else prices[:, columns], dtype=float)
+    prices[(trading[i] < previous) | (trading[i] > end_offsets)] = np.nan
+    return prices
+
+
+@profiled('simulation')
+def backtest(mode, budgets, entry_dates, horizon, n_paths: int = 1, seed=None,
+             investment_weights: tuple = (75, 25)):
+    """Simulates n_paths portfolios of a mode for every entry date, each one held for horizon days
+    (an int or a timedelta). Budgets is a number or one budget per row.
+
+    Entry dates are sorted and rows are entry by entry: row i belongs to entry i // n_paths. Returns a
+    Backtest with the sorted entry dates, the (rows x horizon) value matrix, the first allocation of each
+    row and the parameters. With one entry date, values are those of simulate with the same seed.
+    """
+    if mode not in {defensive, aggressive, mixed}:
+        raise ValueError("mode must be on of defensive, aggressive, mixed")
+    entry_dates = pd.DatetimeIndex(entry_dates, name='Date').sort_values()
+    if not len(entry_dates):
+        raise ValueError('entry_dates must not be empty')
+    horizon = horizon.days if isinstance(horizon, timedelta) else int(horizon)
+    n_rows = len(entry_dates) * n_paths
+    budgets = np.broadcast_to(np.asarray(budgets, dtype=float), (n_rows,))
+    if (budgets < 0).any():
+        raise ValueError('budgets must be >= 0')
+    rng = np.random.default_rng(seed)
+    universe = get_universe()
+    columns = _universe_columns()
+    cumulative = None if universe.cumulative is None else np.array(universe.cumulative)
+    first = calendar.offset(entry_dates[0])
+    _, matrix = _price_matrix(entry_dates[0], entry_dates[-1] + timedelta(days=horizon), columns)
+    entries = np.repeat(calendar.offsets(entry_dates) - first, n_paths)  # first day of each row in matrix
+    window = np.arange(horizon)
+    values = np.zeros((n_rows, horizon))
+    allocations = None
+    # Day of the window -> list of (rows, budgets) reinvested on that day, in maturity order as simulate does
+    pending = {0: [(np.arange(n_rows), budgets)]}
+    while pending:
+        day = min(pending)
+        rows = np.concatenate([row for row, _ in pending[day]])
+        budget = np.concatenate([budget for _, budget in pending.pop(day)])
+        offset = np.full(len(rows), day)
+        # A row comes twice when its short and long bonds mature the same day
+        repeated = len(np.unique(rows)) < len(rows)
+        shares, bonds, cash = _allocate(mode, budget, _purchase_price_rows(first + entries[rows] + offset,
+                                                                           first + entries[rows] + horizon, columns),
+                                        investment_weights, rng, cumulative)
+        if allocations is None:
+            allocations = {'budget': budgets.copy(), 'shares': shares, 'short': bonds[:, 0],
+                           'long': bonds[:, 1], 'cash': cash}
+        cash = cash.copy()  # cash left on each row, reinvested with its first maturing bond
+        held = np.flatnonzero(shares.any(axis=0))
+        if held.size:
+            # Sliding windows: day k of row r is row entries[r] + k of the price matrix
+            days = entries[rows, None] + window
+            live = window >= offset[:, None]
+            for column in held:
+                _add_rows(values, rows, np.where(live, shares[:, column, None] * matrix[days, column], 0), repeated)
+        for column, kind in enumerate(['short', 'long']):
+            bought = bonds[:, column] > 0
+            if not bought.any():
+                continue
+            rate, years, _ = Bonds.terms[kind]
+            start = offset[bought]
+            start_dates = calendar.origin + pd.to_timedelta(first + entries[rows[bought]] + start, unit='D')
+            term = ((start_dates + pd.DateOffset(years=years)) - start_dates).days.values
+            pv = bonds[bought, column]
+            # The curve is separable: (1 + rate) ** ((k - start) / 365) = growth[k] / growth[start]
+            growth = (1 + rate) ** (window / 365)
+            live = (window >= start[:, None]) & (window < (start + term)[:, None])
+            _add_rows(values, rows[bought], np.where(live, (pv * (1 + rate) ** (-start / 365))[:, None] * growth, 0),
+                      repeated)
+            rolled = start + term < horizon
+            if rolled.any():
+                # The bond last value plus the cash left (once per row) is reinvested, as simulate does
+                final = pv * (1 + rate) ** ((term - 1) / 365) + cash[bought]
+                maturity = start + term
+                for day in np.unique(maturity[rolled]):
+                    matured = rolled & (maturity == day)
+                    pending.setdefault(int(day), []).append((rows[bought][matured], final[matured]))
+                cash[np.flatnonzero(bought)[rolled]] = 0
+    params = {'mode': mode.__name__, 'n_paths': n_paths, 'horizon': horizon, 'seed': seed,
+              'investment_weights': tuple(investment_weights), 'tickers': list(universe.tickers)}
+    return Backtest(entry_dates, values, allocations, params)
+
+
+def _add_rows(values, rows, block, repeated):
+    """values[rows] += block, adding every occurrence of the repeated rows"""
+    if repeated:
+        np.add.at(values, rows, block)
+    else:
+        values[rows] += block
+
+
+def return_and_vol_by_entry(result: Backtest):
+    """Mean return and mean daily volatility of the paths of each entry date"""
+    returns, vol = _returns_and_vol(result.values)
+    n_paths = result.params['n_paths']
+    return pd.DataFrame({'Investment return': np.nanmean(returns.reshape(-1, n_paths), axis=1),
+                         'daily volatility': np.nanmean(vol.reshape(-1, n_paths), axis=1)}, index=result.entry_dates)
+
+
+# Parameter sweeps. Every scenario of a grid is simulated with the same seed (common random numbers),
+# so differences between scenarios come from the parameters and not from the draws. Prices, the price
+# index, bond curves and the price matrix of each date range are computed once and shared.
+
+_sweep_defaults = {'mode': [mixed], 'budget': [5000], 'investment_weights': [(75, 25)],
+                   'start_date': [datetime(2016, 9, 1)], 'end_date': [datetime(2021, 1, 1)]}
+
+
+@profiled('simulation')
+def sweep(grid: dict, n_paths: int = 1000, seed=0):
+    """Simulates every combination of the grid values, e.g.
+    sweep({'mode': [defensive, aggressive], 'budget': [5000, 50000], 'investment_weights': [(75, 25), (25, 75)]}).
+    Keys are mode (function or name), budget, investment_weights, start_date and end_date; missing ones
+    take the values of the scripts. Returns one row per scenario with the mean return and volatility
+    and their standard errors"""
+    unknown = set(grid) - set(_sweep_defaults)
+    if unknown:
+        raise ValueError(f'unknown sweep parameters: {sorted(unknown)}')
+    grid = dict(_sweep_defaults, **{key: list(values) for key, values in grid.items()})
+    modes = {'defensive': defensive, 'aggressive': aggressive, 'mixed': mixed}
+    rows = []
+    for scenario in itertools.product(*grid.values()):
+        scenario = dict(zip(grid, scenario))
+        mode = modes.get(scenario['mode'], scenario['mode'])
+        if mode is not mixed and scenario['investment_weights'] != grid['investment_weights'][0]:
+            continue  # weights only change mixed portfolios
+        values = simulate(mode, scenario['budget'], scenario['start_date'], scenario['end_date'], n_paths,
+                          seed=seed, investment_weights=scenario['investment_weights']).values
+        returns, vol = _returns_and_vol(values)
+        rows.append({'mode': mode.__name__, 'budget': scenario['budget'],
+                     'investment_weights': tuple(scenario['investment_weights']),
+                     'start_date': pd.Timestamp(scenario['start_date']),
+                     'end_date': pd.Timestamp(scenario['end_date']),
+                     'n_paths': n_paths, 'Investment return': np.nanmean(returns), 'daily volatility': np.nanmean(vol),
+                     'return standard error': np.nanstd(returns, ddof=1) / math.sqrt(np.isfinite(returns).sum()),
+                     'volatility standard error': np.nanstd(vol, ddof=1) / math.sqrt(np.isfinite(vol).sum())})
+    return pd.DataFrame(rows)
+
+
+@profiled('aggregation')
+def return_and_vol_on_simulations(simulations: list, lists_names: list):
+    """Computes mean return and the mean volatility for each simulation, as return_and_vol_on_portfolios"""
+    return_on_group = {}
+    for name, simulation in zip(lists_names, simulations):
+        returns, vol = [], []
+        for values in _row_chunks(simulation.values):
+            path_returns, path_vol = _returns_and_vol(values)
+            returns.append(path_returns)
+            vol.append(path_vol)
+        return_on_group[name] = (round(np.nanmean(np.concatenate(returns)), 4),
+                                 round(np.nanmean(np.concatenate(vol)), 4))
+    return pd.DataFrame(return_on_group, index=['Investment return', 'daily volatility'])
+
+
+@profiled('aggregation')
+def mean_monthly_value_on_simulations(simulations: list, lists_names: list):
+    """Calculates the mean monthly values for each simulation, as mean_monthly_value_on_portfolios"""
+    return _group_table([_simulation_period_mean(simulation, 'month_ends', 'month_rows', False)
+                         for simulation in simulations], lists_names)
+
+
+@profiled('aggregation')
+def mean_yearly_return_on_simulations(simulations: list, lists_names: list):
+    """Calculates the mean yearly return for each simulation, as mean_yearly_return_on_portfolios"""
+    return _group_table([_simulation_period_mean(simulation, 'year_ends', 'year_rows', True)
+                         for simulation in simulations], lists_names)
+
+
+def _simulation_period_mean(simulation, ends, rows, returns):
+    """Mean over the paths of the values (or returns) on the period ends, gathered by blocks of rows"""
+    periods = period_boundaries(simulation.params['start_date'], simulation.params['end_date'])
+    ends, rows = getattr(periods, ends), getattr(periods, rows)
+    sums, counts = np.zeros(len(ends)), np.zeros(len(ends))
+    for values in _row_chunks(simulation.values):
+        gathered = gather_periods(values, rows)
+        if returns:
+            gathered = _period_returns(gathered)
+        known = ~np.isnan(gathered)
+        sums += np.where(known, gathered, 0).sum(axis=0)
+        counts += known.sum(axis=0)
+    with np.errstate(invalid='ignore'):
+        return pd.DataFrame({'Value': sums / np.where(counts > 0, counts, np.nan)}, index=ends)
+
+
+def portfolios_simulation(portfolios, **params):
+    """Simulation of a Portfolio group: values of every portfolio on its dates and, as in simulate, its
+    first allocation (shares per ticker of the universe, short and long pv) plus the cash left"""
+    portfolios = list(portfolios)
+    universe = get_universe()
+    shares = np.zeros((len(portfolios), len(universe)))
+    bonds = np.zeros((len(portfolios), 2))
+    for row, portfolio in enumerate(portfolios):
+        # Keys without a reinvestment suffix are the first allocation
+        for key, investment in portfolio.investments.items():
+            if isinstance(investment, Stocks) and key in universe:
+                shares[row, universe.columns[key]] += investment.num_stocks
+            elif key in {'short', 'long'}:
+                bonds[row, ['short', 'long'].index(key)] += investment.pv
+    allocations = {'budget': np.array([portfolio.investor.budget for portfolio in portfolios], dtype=float),
+                   'shares': shares, 'short': bonds[:, 0], 'long': bonds[:, 1],
+                   'cash': np.array([portfolio.budget for portfolio in portfolios], dtype=float)}
+    first = portfolios[0]
+    params = dict({'mode': first.mode.__name__, 'n_paths': len(portfolios),
+                   'start_date': pd.Timestamp(first.start_date), 'end_date': pd.Timestamp(first.end_date),
+                   'seed': None, 'investment_weights': tuple(first.investment_weights),
+                   'tickers': list(universe.tickers)}, **params)
+    return Simulation(first.dates, np.stack([portfolio.values for portfolio in portfolios]), allocations, params)
+
+
+# Simulation store. A run is a directory with the value matrix, dates and allocations as .npy files
+# and the parameters as JSON. Loading maps the arrays, reports read only the rows and days they use.
+
+def save_simulation(simulation: Simulation, path):
+    """Writes a simulation to the directory path"""
+    os.makedirs(path, exist_ok=True)
+    arrays = {'dates': simulation.dates.values.astype('datetime64[ns]'), 'values': simulation.values}
+    arrays.update({'allocation_' + key: value for key, value in simulation.allocations.items()})
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.tmp.npy'), np.asarray(array))
+        os.replace(os.path.join(path, name + '.tmp.npy'), os.path.join(path, name + '.npy'))
+    params = {key: value.isoformat() if isinstance(value, (datetime, pd.Timestamp)) else value
+              for key, value in simulation.params.items()}
+    meta = {'allocations': list(simulation.allocations), 'params': params}
+    with open(os.path.join(path, 'simulation.json'), 'w') as file:
+        json.dump(meta, file, default=str)
+
+
+def load_simulation(path, mmap=True):
+    """Reads a simulation written by save_simulation. Arrays are memory-mapped (read only) unless mmap
+    is False. Raises FileNotFoundError when there is no simulation in path"""
+    with open(os.path.join(path, 'simulation.json')) as file:
+        meta = json.load(file)
+    mmap_mode = 'r' if mmap else None
+    dates = pd.DatetimeIndex(np.load(os.path.join(path, 'dates.npy')), name='Date')
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode=mmap_mode)
+    allocations = {key: np.load(os.path.join(path, f'allocation_{key}.npy'), mmap_mode=mmap_mode)
+                   for key in meta['allocations']}
+    params = meta['params']
+    for key in ('start_date', 'end_date'):
+        params[key] = pd.Timestamp(params[key])
+    params['investment_weights'] = tuple(params['investment_weights'])
+    return Simulation(dates, values, allocations, params)
+
+
+def _stored_param(value):
+    """A parameter as load_simulation reads it back"""
+    if isinstance(value, (datetime, pd.Timestamp)):
+        return pd.Timestamp(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_stored_param(item) for item in value)
+    return value
+
+
+def load_matching_simulation(path, **params):
+    """load_simulation if the stored run has the given parameters, e.g. budget=5000, n_paths=500.
+    Returns None when there is no run in path or a parameter differs, so the caller simulates again"""
+    try:
+        simulation = load_simulation(path)
+    except FileNotFoundError:
+        return None
+    stored = simulation.params
+    if any(key not in stored or _stored_param(stored[key]) != _stored_param(value) for key, value in params.items()):
+        return None
+    return simulation
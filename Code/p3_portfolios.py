@@ -15,21 +15,34 @@ register_matplotlib_converters()
 start_date = datetime(2016, 9, 1)
 end_date = datetime(2021, 1, 1)
 budget = 5000
+n = 500
 
-# Call Portfolios
-defensive = invsim.Investor(invsim.defensive, budget)
-defensive_group = [invsim.Portfolio(defensive, start_date=start_date, end_date=end_date) for _ in range(500)]
 
-aggressive = invsim.Investor(invsim.aggressive, budget)
-aggressive_group = [invsim.Portfolio(aggressive, start_date=start_date, end_date=end_date) for _ in range(500)]
+# Call Portfolios. Their values are stored in Results/simulations, later runs read them back as long
+# as they were simulated with the same parameters. Delete the directory to simulate again.
+def build_groups():
+    defensive = invsim.Investor(invsim.defensive, budget)
+    defensive_group = [invsim.Portfolio(defensive, start_date=start_date, end_date=end_date) for _ in range(n)]
+
+    aggressive = invsim.Investor(invsim.aggressive, budget)
+    aggressive_group = [invsim.Portfolio(aggressive, start_date=start_date, end_date=end_date) for _ in range(n)]
+
+    mixed = invsim.Investor(invsim.mixed, budget)
+    mixed_group = [invsim.Portfolio(mixed, start_date=start_date, end_date=end_date) for _ in range(n)]
+    return [defensive_group, aggressive_group, mixed_group]
 
-mixed = invsim.Investor(invsim.mixed, budget)
-mixed_group = [invsim.Portfolio(mixed, start_date=start_date, end_date=end_date) for _ in range(500)]
 
-groups = [defensive_group, aggressive_group, mixed_group]
 names = ['defensive', 'aggressive', 'mixed']
+store = [os.path.abspath(f'../Results/simulations/p3_{name}') for name in names]
+params = [dict(mode=name, budget=budget, n_paths=n, start_date=start_date, end_date=end_date,
+               investment_weights=weights) for name, weights in zip(names, [(75, 25)] * 3)]
+groups = [invsim.load_matching_simulation(path, **group_params) for path, group_params in zip(store, params)]
+if any(group is None for group in groups):
+    groups = [invsim.portfolios_simulation(group, budget=budget) for group in build_groups()]
+    for group, path in zip(groups, store):
+        invsim.save_simulation(group, path)
 
-results = invsim.return_and_vol_on_portfolios(groups, names)
+results = invsim.return_and_vol_on_simulations(groups, names)
 
 fig, ax = plt.subplots(figsize=(8, 2))
 ax.xaxis.set_visible(False)
@@ -42,7 +55,7 @@ tabla.scale(1.2, 1.5)
 plt.savefig('../Results/p3_portfolios_returns_and_vol.png', transparent=True)
 
 
-means = invsim.mean_monthly_value_on_portfolios(groups, names)
+means = invsim.mean_monthly_value_on_simulations(groups, names)
 
 sns.set_theme()
 sns.set_context("paper", font_scale=1.5)
@@ -55,7 +68,7 @@ ax.xaxis.set_major_formatter(date_form)
 plt.savefig(os.path.abspath('../Results/p3_portfolios_monthly_price_plot.png'), dpi=800)
 
 
-results = invsim.mean_yearly_return_on_portfolios(groups, names)
+results = invsim.mean_yearly_return_on_simulations(groups, names)
 
 
 sns.set_theme()
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+# Risk metrics over simulated paths. Every function takes a (paths x days) value matrix, e.g.
+# Simulation.values or a memory-mapped stored run, and reads it by blocks of rows so memory
+# doesn't grow with the number of paths. Days are calendar days, as in investor_simulator.
+
+periods_per_year = 365
+
+
+def _blocks(values, size=1024):
+    """Row blocks of a value matrix as float arrays"""
+    for first in range(0, len(values), size):
+        yield np.asarray(values[first:first + size], dtype=float)
+
+
+def _daily_rate(rate, periods):
+    return (1 + rate) ** (1 / periods) - 1
+
+
+# Metrics per path, computed in a single pass over the matrix
+
+def path_metrics(values, risk_free=0.0, periods=periods_per_year):
+    """Return, daily volatility, max drawdown, Sharpe and Sortino ratios of every path.
+    risk_free is an annual rate, ratios are annualized with periods days a year"""
+    daily_free = _daily_rate(risk_free, periods)
+    metrics = {key: [] for key in ('return', 'volatility', 'max_drawdown', 'sharpe', 'sortino')}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for block in _blocks(values):
+            returns = np.divide(block[:, 1:], block[:, :-1])
+            returns -= 1
+            volatility = returns.std(axis=1, ddof=1)
+            mean_excess = returns.mean(axis=1) - daily_free
+            # The returns are not used after this, downside deviation is computed in place
+            returns -= daily_free
+            np.minimum(returns, 0, out=returns)
+            returns *= returns
+            downside = np.sqrt(returns.mean(axis=1))
+            metrics['return'].append(block[:, -1] / block[:, 0] - 1)
+            metrics['volatility'].append(volatility)
+            metrics['max_drawdown'].append(_max_drawdown(block))
+            metrics['sharpe'].append(mean_excess / volatility * np.sqrt(periods))
+            metrics['sortino'].append(mean_excess / downside * np.sqrt(periods))
+    return {key: np.concatenate(value) if value else np.empty(0) for key, value in metrics.items()}
+
+
+def _max_drawdown(block):
+    """Largest fall from a running peak, as a fraction of the peak (0 for paths that never fall)"""
+    ratio = np.maximum.accumulate(block, axis=1)
+    np.divide(block, ratio, out=ratio)
+    return np.nan_to_num(1 - np.nanmin(ratio, axis=1), nan=0.0)
+
+
+def max_drawdown(values):
+    """Max drawdown of every path"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.concatenate([_max_drawdown(block) for block in _blocks(values)] or [np.empty(0)])
+
+
+# Metrics across paths
+
+def value_at_risk(returns, level=0.95):
+    """Loss not exceeded with probability level, from the returns of the paths (positive is a loss)"""
+    returns = np.asarray(returns, dtype=float)
+    return -np.nanquantile(returns, 1 - level)
+
+
+def conditional_value_at_risk(returns, level=0.95):
+    """Mean loss of the paths at or beyond the value at risk (expected shortfall)"""
+    returns = np.asarray(returns, dtype=float)
+    returns = returns[np.isfinite(returns)]
+    tail = returns[returns <= np.quantile(returns, 1 - level)]
+    return -tail.mean()
+
+
+def percentile_fan(values, percentiles=(5, 25, 50, 75, 95), dates=None, size=128):
+    """Percentiles of the path values on every day, one row per percentile (a fan chart).
+    Reads the matrix by blocks of days. With dates, returns a DataFrame with one column per percentile"""
+    n_days = np.shape(values)[1]
+    fan = np.empty((len(percentiles), n_days))
+    for first in range(0, n_days, size):
+        # One contiguous row per day, partitioning along rows is much faster than across them
+        days = np.ascontiguousarray(np.asarray(values[:, first:first + size], dtype=float).T)
+        percentile = np.nanpercentile if np.isnan(days).any() else np.percentile
+        fan[:, first:first + size] = percentile(days, percentiles, axis=1)
+    if dates is None:
+        return fan
+    return pd.DataFrame(fan.T, index=pd.Index(dates, name='Date'), columns=list(percentiles))
+
+
+def risk_summary(values, level=0.95, risk_free=0.0, periods=periods_per_year):
+    """Group figures of a value matrix: mean return and volatility, VaR and CVaR of the return,
+    mean and worst max drawdown, mean Sharpe and Sortino ratios"""
+    metrics = path_metrics(values, risk_free, periods)
+    returns = metrics['return']
+    return {'Investment return': np.nanmean(returns),
+            'daily volatility': np.nanmean(metrics['volatility']),
+            f'VaR {level:.0%}': value_at_risk(returns, level),
+            f'CVaR {level:.0%}': conditional_value_at_risk(returns, level),
+            'mean max drawdown': np.nanmean(metrics['max_drawdown']),
+            'worst max drawdown': np.nanmax(metrics['max_drawdown']),
+            'Sharpe ratio': np.nanmean(metrics['sharpe'][np.isfinite(metrics['sharpe'])]),
+            'Sortino ratio': np.nanmean(metrics['sortino'][np.isfinite(metrics['sortino'])])}
+
+
+def risk_on_simulations(simulations: list, lists_names: list, level=0.95, risk_free=0.0):
+    """Risk summary of each simulation (or value matrix), a table like return_and_vol_on_simulations"""
+    summaries = {name: risk_summary(getattr(simulation, 'values', simulation), level, risk_free)
+                 for name, simulation in zip(lists_names, simulations)}
+    # Rows in the order of risk_summary, a dict of dicts would sort them alphabetically
+    rows = next(iter(summaries.values()), {}).keys()
+    return pd.DataFrame(summaries, index=list(rows)).round(4)
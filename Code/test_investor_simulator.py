@@ -0,0 +1,186 @@
+import investor_simulator as invsim
+import collections
+import gc
+import http.server
+import json
+import threading
+import types
+import weakref
+import numpy as np
+import pandas as pd
+import pytest
+import time
+from datetime import datetime
+
+# Regression checks, offline on a synthetic price panel. Run with python -m pytest from Code.
+
+start_date = datetime(2000, 1, 3)
+end_date = datetime(2020, 1, 3)
+
+
+@pytest.fixture(autouse=True)
+def prices():
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range(datetime(1999, 6, 1), datetime(2020, 6, 30), name='Date')
+    tickers = ['FDX', 'GOOGL', 'XOM', 'KO', 'NOK', 'MS', 'IBM']
+    steps = rng.normal(0.0003, 0.015, size=(len(dates), len(tickers)))
+    invsim.set_price_source(invsim.FrameSource(pd.DataFrame(40 * np.exp(np.cumsum(steps, axis=0)),
+                                                            index=dates, columns=tickers)))
+
+
+def test_leftover_cash_reinvested_once():
+    """The cash left by a tranche with a short and a long bond rides with the short one only"""
+    def invest(tranche):
+        if tranche.start_date != start_date:
+            return {}  # reinvestments keep their budget as cash
+        tranche.budget -= 1250
+        return {'short': invsim.Bonds.short(start_date, pv=250), 'long': invsim.Bonds.long(start_date, pv=1000)}
+
+    portfolio = types.SimpleNamespace(mode=invsim.defensive, budget=1450, start_date=start_date,
+                                      end_date=end_date, investment_weights=(75, 25), rng=None)
+    investments = invsim._invest_with_rollover(portfolio, invest, rollover_at_end=False)
+    assert portfolio.budget == pytest.approx(investments['short'].final_value + investments['long'].final_value + 200)
+
+
+def test_engines_agree_on_rollovers():
+    """Defensive portfolios over 20 years: Portfolio and simulate reinvest the same budgets"""
+    portfolios = invsim.run_simulations(invsim.Investor(invsim.defensive, 1450), 100, start_date, end_date,
+                                        workers=1, seed=1)
+    simulation = invsim.simulate(invsim.defensive, 1450, start_date, end_date, 2000, seed=1)
+    assert np.mean([portfolio.values[-1] for portfolio in portfolios]) == pytest.approx(
+        simulation.values[:, -1].mean(), rel=0.01)
+
+
+def test_profile_phases_within_wall_time():
+    """Nested instrumented calls count once: the phase totals split the run time"""
+    with invsim.profiling() as profiler:
+        start = time.perf_counter()
+        for i in range(30):
+            invsim.Portfolio(invsim.Investor(invsim.defensive, 5000), start_date, end_date,
+                             rng=np.random.default_rng(i))
+        wall = time.perf_counter() - start
+    report = profiler.to_dict()
+    assert report['functions']['defensive']['calls'] == 30
+    assert sum(report['phases'].values()) <= wall
+
+
+def test_backtest_entry_dates():
+    """Entry dates in any order are sorted, an empty list is an error"""
+    result = invsim.backtest(invsim.mixed, 5000, [datetime(2014, 6, 2), datetime(2012, 3, 1)], 3000, 5, seed=1)
+    assert list(result.entry_dates) == [pd.Timestamp(2012, 3, 1), pd.Timestamp(2014, 6, 2)]
+    assert result.values.shape == (10, 3000)
+    with pytest.raises(ValueError):
+        invsim.backtest(invsim.mixed, 5000, [], 3000)
+
+
+@pytest.mark.parametrize('mode', [invsim.defensive, invsim.aggressive, invsim.mixed])
+def test_backtest_single_entry_is_simulate(mode):
+    """Rollovers are reinvested in maturity order, so one entry date draws as simulate does"""
+    simulation = invsim.simulate(mode, 5000, start_date, end_date, 50, seed=4)
+    result = invsim.backtest(mode, 5000, [start_date], (end_date - start_date).days, 50, seed=4)
+    np.testing.assert_allclose(result.values, simulation.values)
+
+
+def test_offline_refresh_keeps_cache(tmp_path):
+    """When the upstream fetches nothing, a warm cache is read as it is, not written again"""
+    class Offline(invsim.PriceSource):
+        errors = {'KO': 'offline'}
+
+        def fetch(self, tickers, start, end):
+            return pd.DataFrame()
+
+    online = invsim.FrameSource(invsim.get_price_source().fetch(['KO', 'IBM'], None, None))
+    invsim.CachedSource(str(tmp_path), online, start=datetime(2005, 1, 3), end=datetime(2010, 1, 4)).prices
+    version = invsim._cache_version(str(tmp_path))
+    prices = invsim.CachedSource(str(tmp_path), Offline(['KO', 'IBM']), start=datetime(2004, 1, 2),
+                                 end=datetime(2012, 1, 3)).prices
+    assert invsim._cache_version(str(tmp_path)) == version
+    assert list(prices.columns) == ['KO', 'IBM'] and prices.index[0] == pd.Timestamp(2005, 1, 3)
+
+
+def test_picks_draw_once():
+    """pick_stock and pick_bond make one draw of the samplers and leave the budget to the caller"""
+    portfolio = invsim.Portfolio(invsim.Investor(invsim.mixed, 3000), start_date, end_date,
+                                 rng=np.random.default_rng(1))
+    portfolio.budget = 3000
+    bonds, cost = invsim.pick_bond(portfolio)
+    assert bonds in ({'short': 250}, {'long': 1000}) and cost == sum(bonds.values()) and portfolio.budget == 3000
+    stocks, cost = invsim.pick_stock(portfolio)
+    (ticker, shares), = stocks.items()
+    assert 0 < cost <= 3000 and cost / shares == pytest.approx(invsim.get_price_index().first(
+        ticker, invsim._previous_business_day(start_date), end_date))
+    portfolio.budget = 600
+    assert invsim.pick_bond(portfolio) == ({'short': 600}, 600)
+
+
+@pytest.fixture
+def chart_server():
+    """Local stub of the chart API: BAD is unknown (404), FLAKY fails twice with 503, others are KO"""
+    hits = collections.Counter()
+    panel = invsim.get_price_source().prices
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            ticker = self.path.split('?')[0].split('/')[-1]
+            hits[ticker] += 1
+            if ticker == 'BAD':
+                return self.send_error(404)
+            if ticker == 'FLAKY' and hits[ticker] < 3:
+                return self.send_error(503)
+            prices = panel['KO'].loc['2015-01-01':'2015-12-31']
+            body = json.dumps({'chart': {'result': [{
+                'meta': {'gmtoffset': 0}, 'timestamp': (prices.index.astype('int64') // 10 ** 9).tolist(),
+                'indicators': {'quote': [{'high': prices.tolist()}]}}]}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/chart/{{ticker}}?period1={{period1}}&period2={{period2}}', hits
+    server.shutdown()
+    server.server_close()
+
+
+def test_async_source_errors_retries_and_partial_results(chart_server):
+    """Unknown tickers go to errors, failing ones are retried, the others still make the panel"""
+    url, hits = chart_server
+    source = invsim.AsyncYahooSource(['KO', 'BAD', 'FLAKY'], start=datetime(2015, 1, 1), end=datetime(2015, 12, 31),
+                                     url=url, retry_delay=0.01)
+    prices = source.prices
+    assert list(prices.columns) == ['KO', 'FLAKY']
+    pd.testing.assert_series_equal(prices['KO'], invsim.get_price_source().prices['KO'].loc['2015'],
+                                   check_names=False, check_freq=False)
+    assert list(source.errors) == ['BAD'] and source.errors['BAD'].code == 404
+    assert hits['BAD'] == 1 and hits['FLAKY'] == 3
+
+
+def test_async_source_nothing_fetched(chart_server):
+    """Loading raises when every ticker fails"""
+    url, hits = chart_server
+    source = invsim.AsyncYahooSource(['BAD'], start=datetime(2015, 1, 1), end=datetime(2015, 12, 31), url=url)
+    with pytest.raises(ValueError):
+        source.prices
+
+
+def test_replaced_source_is_released():
+    """Caches keyed by the price source do not keep a replaced source alive"""
+    source = weakref.ref(invsim.get_price_source())
+    invsim.simulate(invsim.mixed, 5000, start_date, end_date, 10, seed=1)
+    invsim.run_simulations(invsim.Investor(invsim.aggressive, 5000), 2, start_date, end_date, workers=1, seed=1)
+    invsim.set_price_source(invsim.FrameSource(invsim.get_price_source().prices))
+    gc.collect()
+    assert source() is None
+
+
+def test_source_without_fetch():
+    """A price source must implement fetch, it fails when built rather than on first load"""
+    class Incomplete(invsim.PriceSource):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -1,4 +1,7 @@
 import Code.investor_simulator as invsim
+import collections
+import copy
+import threading
 from datetime import datetime
 from datetime import date, timedelta
 import streamlit as st
@@ -30,25 +33,62 @@ budget = st.sidebar.slider('Define the budget', min_value=1000, max_value=100000
 stock_weight = st.sidebar.slider('% of Stocks on Mixed Portfolio', min_value=0, max_value=100, value=50, step=10)
 simulations = st.sidebar.slider('Simulations', min_value=50, max_value=500, value=50, step=50)
 
+seed = st.sidebar.number_input('Seed', min_value=0, value=0, step=1)
+
 start_date = datetime.combine(start_date_sb, datetime.min.time())
 end_date = datetime.combine(end_date_sb, datetime.min.time())
 
-# Call Portfolios
-defensive = invsim.Investor(invsim.defensive, budget)
-defensive_group = [invsim.Portfolio(defensive, start_date=start_date, end_date=end_date) for _ in range(simulations)]
 
-aggressive = invsim.Investor(invsim.aggressive, budget)
-aggressive_group = [invsim.Portfolio(aggressive, start_date=start_date, end_date=end_date) for _ in range(simulations)]
+# Prices and simulated statistics are cached across reruns and sessions. A widget change that keeps
+# the simulation inputs only redraws, and more simulations only build the portfolios not counted yet.
+# Portfolios are not kept: each input combination holds its GroupStatistics, the most recent
+# cache_size ones are kept.
+cache_size = 32
+
+
+@st.cache(allow_output_mutation=True)
+def price_source():
+    """Prices and their lookup index, loaded once per server"""
+    source = invsim.get_price_source()
+    source.index
+    return source
+
 
-mixed = invsim.Investor(invsim.mixed, budget)
-mixed_group = [invsim.Portfolio(mixed, start_date=start_date, end_date=end_date,
-                                investment_weights=(stock_weight, 100 - stock_weight))
-               for _ in range(simulations)]
+@st.cache(allow_output_mutation=True)
+def simulation_cache():
+    """(mode, budget, start, end, weights, seed) -> statistics, shared by the sessions with its lock"""
+    return collections.OrderedDict(), threading.Lock()
 
-groups = [defensive_group, aggressive_group, mixed_group]
+
+def group_statistics(mode, investment_weights=(75, 25)):
+    key = (mode.__name__, budget, start_date, end_date, investment_weights, seed)
+    cache, lock = simulation_cache()
+    with lock:
+        statistics = cache.get(key)
+    # Sessions run on concurrent threads, each one extends its own copy
+    statistics = invsim.GroupStatistics() if statistics is None or statistics.count > simulations \
+        else copy.deepcopy(statistics)
+    if statistics.count < simulations:
+        # Portfolio i has its own seeded stream, the new ones are the same as in a run from scratch
+        statistics.update(invsim.run_simulations(invsim.Investor(mode, budget), simulations - statistics.count,
+                                                 start_date, end_date, investment_weights=investment_weights,
+                                                 workers=1, seed=seed, first=statistics.count))
+    with lock:
+        cache[key] = statistics
+        cache.move_to_end(key)
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+    return statistics
+
+
+invsim.set_price_source(price_source())
+
+# Call Portfolios
+statistics = [group_statistics(invsim.defensive), group_statistics(invsim.aggressive),
+              group_statistics(invsim.mixed, (stock_weight, 100 - stock_weight))]
 names = ['defensive', 'aggressive', 'mixed']
 
-results = invsim.return_and_vol_on_portfolios(groups, names)
+results, means, annual_returns = invsim.tables_on_statistics(statistics, names)
 
 header = ['Index', 'Defensive', 'Aggressive', 'Mixed']
 
@@ -63,7 +103,6 @@ fig = go.Figure(data=[go.Table(
 st.plotly_chart(fig, use_container_width=True)
 
 # Line Plot
-means = invsim.mean_monthly_value_on_portfolios(groups, names)
 
 fig = px.line(means.reset_index(), x="Date", y="Value", color='Portfolio_group', title='Portfolio Value'
               , height=600, template='plotly_white',
@@ -72,7 +111,7 @@ fig.update_layout(legend=dict(title=None, orientation="h", y=1, yanchor="bottom"
 st.plotly_chart(fig, use_container_width=True)
 
 
-results = invsim.mean_yearly_return_on_portfolios(groups, names).dropna()
+results = annual_returns.dropna()
 
 results['Date'] = results.Date.map(lambda x: x.year)
 